@@ -1,14 +1,18 @@
 from library.app import RAW_MODE
-from functions.torboxFunctions import getUserDownloads, DownloadType
-from library.filesystem import MOUNT_METHOD, MOUNT_PATH
-from library.app import MOUNT_REFRESH_TIME
+from functions.torboxFunctions import DownloadType, MetadataLookups
+from functions.syncFunctions import syncUserDownloads
+from library.filesystem import MOUNT_METHOD, MOUNT_PATH, STRM_MANIFEST_PATH, MountMethods
+from library.app import MOUNT_REFRESH_TIME, WARM_START
 from library.torbox import TORBOX_API_KEY
-from functions.databaseFunctions import getAllData, clearDatabase
+from functions.databaseFunctions import getAllData, getGeneration
+from library.http import asyncApiClient, asyncSearchApiClient
+from library.ratelimit import limiterStats
 import logging
+import asyncio
 import os
 import shutil
 
-def initializeFolders():
+def initializeFolders(wipe: bool = True):
     folders = [MOUNT_PATH]
     if not RAW_MODE:
         folders.extend([
@@ -17,6 +21,9 @@ def initializeFolders():
         ])
     for folder in folders:
         if os.path.exists(folder):
+            if not wipe:
+                logging.debug(f"Folder {folder} already exists. Keeping its contents...")
+                continue
             logging.debug(f"Folder {folder} already exists. Deleting...")
             for item in os.listdir(folder):
                 item_path = os.path.join(folder, item)
@@ -29,37 +36,61 @@ def initializeFolders():
             os.makedirs(folder, exist_ok=True)
 
 def getAllUserDownloadsFresh():
-    all_downloads = []
+    return asyncio.run(syncAllUserDownloads())
+
+async def syncAllUserDownloads():
+    """
+    Syncs every download type with the API, returning how many files are stored.
+    """
     logging.info("Fetching all user downloads...")
-    for download_type in DownloadType:
-        logging.debug(f"Clearing database for {download_type.value}...")
-        success, detail = clearDatabase(download_type.value)
-        if not success:
-            logging.error(f"Error clearing {download_type.value} database: {detail}")
-            continue
-        logging.debug(f"Fetching {download_type.value} downloads...")
-        downloads, success, detail = getUserDownloads(download_type)
-        if not success:
-            logging.error(f"Error fetching {download_type.value}: {detail}")
-            continue
-        if not downloads:
-            logging.info(f"No {download_type.value} downloads found.")
-            continue
-        all_downloads.extend(downloads)
-        logging.debug(f"Fetched {len(downloads)} {download_type.value} downloads.")
-    return all_downloads
+    async with asyncApiClient() as api_client, asyncSearchApiClient() as search_client:
+        # every download type is synced at once, sharing metadata lookups
+        lookups = MetadataLookups(search_client)
+        results = await asyncio.gather(*[syncDownloadType(download_type, api_client, lookups) for download_type in DownloadType])
+    logging.debug(f"Rate limiter stats: {limiterStats()}")
+    return sum(results)
+
+async def syncDownloadType(download_type: DownloadType, api_client, lookups: MetadataLookups):
+    logging.debug(f"Syncing {download_type.value} downloads...")
+    file_count, success, detail = await syncUserDownloads(download_type, api_client, lookups)
+    if not success:
+        logging.error(f"Error fetching {download_type.value}: {detail}")
+        return 0
+    if not file_count:
+        logging.info(f"No {download_type.value} downloads found.")
+        return 0
+    logging.debug(f"Synced {file_count} {download_type.value} files.")
+    return file_count
 
 def getAllUserDownloads():
+    """
+    Returns the stored downloads of every type and whether all of them could be read. The downloads are incomplete
+    if not, so they must not be taken for the library, as files missing from them would be removed.
+    """
     all_downloads = []
     for download_type in DownloadType:
         logging.debug(f"Fetching {download_type.value} downloads...")
         downloads, success, detail = getAllData(download_type.value)
         if not success:
             logging.error(f"Error fetching {download_type.value}: {detail}")
-            continue
+            return all_downloads, False
         all_downloads.extend(downloads)
         logging.debug(f"Fetched {len(downloads)} {download_type.value} downloads.")
-    return all_downloads
+    return all_downloads, True
+
+def getPublishedGenerations():
+    """
+    Returns the published generation of every download type, or None if one of them can't be read.
+    The stored downloads only change when one of these does.
+    """
+    generations = {}
+    for download_type in DownloadType:
+        generation, success, detail = getGeneration(download_type.value)
+        if not success:
+            logging.error(f"Error checking the stored {download_type.value}: {detail}")
+            return None
+        generations[download_type.value] = generation
+    return generations
 
 def bootUp():
     logging.debug("Booting up...")
@@ -67,15 +98,39 @@ def bootUp():
     logging.info("Mount path: %s", MOUNT_PATH)
     logging.info("TorBox API Key: %s", TORBOX_API_KEY)
     logging.info("Mount refresh time: %s %s", MOUNT_REFRESH_TIME, "hours")
-    initializeFolders()
+    initializeFolders(wipe=not canKeepStrmFiles())
 
     return True
 
+def canKeepStrmFiles():
+    """
+    Returns whether the mount can be kept from the last run. Only strm files that a manifest keeps track of can be,
+    a fuse mount point has to be empty to mount on.
+    """
+    return WARM_START and MOUNT_METHOD == MountMethods.strm.value and os.path.exists(STRM_MANIFEST_PATH)
+
+def canWarmStart():
+    """
+    Returns whether the library stored by the last run can be mounted before refreshing it. The database must hold
+    a published refresh for that, otherwise an empty library would be mounted until the first refresh is done.
+    """
+    return WARM_START and any(hasPublishedGeneration(download_type) for download_type in DownloadType)
+
+def hasPublishedGeneration(download_type: DownloadType):
+    generation, success, detail = getGeneration(download_type.value)
+    if not success:
+        logging.error(f"Error checking the stored {download_type.value}: {detail}")
+        return False
+    return generation > 0
+
 def getMountMethod():
     return MOUNT_METHOD
 
 def getMountPath():
     return MOUNT_PATH
 
+def getWarmStart():
+    return WARM_START
+
 def getMountRefreshTime():
     return MOUNT_REFRESH_TIME
@@ -0,0 +1,327 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+import threading
+import logging
+import mmap
+import os
+
+DISK_CACHE_OPEN_CHUNKS = 64 # chunks kept mapped between reads
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls for the same keys.
+
+    The first caller runs the function and every caller asking for one of its keys while it
+    is running waits for, and shares, its result instead of running the function again.
+    """
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def inFlight(self, key):
+        with self.lock:
+            return key in self.calls
+
+    def do(self, keys: list, function, *args):
+        with self.lock:
+            future = self.calls.get(keys[0])
+            leader = future is None
+            if leader:
+                future = Future()
+                claimed = [key for key in keys if key not in self.calls]
+                for key in claimed:
+                    self.calls[key] = future
+        if not leader:
+            return future.result()
+
+        try:
+            result = function(*args)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                for key in claimed:
+                    del self.calls[key]
+
+class BlockCache:
+    """
+    Byte-budgeted LRU cache for file blocks.
+
+    Keys are `(file, block_index)` tuples. When the cache is over budget, blocks are
+    evicted in least recently used order, preferring blocks of files that hold more
+    than their fair share of the budget so one large stream can't starve the others.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.blocks = OrderedDict()
+        self.file_bytes = {}
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self.blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+    def put(self, key, block):
+        with self.lock:
+            if key in self.blocks:
+                self._remove(key)
+            self.blocks[key] = block
+            self.file_bytes[key[0]] = self.file_bytes.get(key[0], 0) + len(block)
+            self.current_bytes += len(block)
+            while self.current_bytes > self.max_bytes and len(self.blocks) > 1:
+                self._remove(self._pickVictim(key))
+                self.evictions += 1
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.blocks
+
+    def invalidate(self, file):
+        """
+        Drops every cached block belonging to a file.
+        """
+        with self.lock:
+            for key in [key for key in self.blocks if key[0] == file]:
+                self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "blocks": len(self.blocks),
+                "files": len(self.file_bytes),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _pickVictim(self, inserted_key):
+        fair_share = self.max_bytes // max(len(self.file_bytes), 1)
+        inserting_file = inserted_key[0]
+        fallback = None
+        for key in self.blocks:
+            if key == inserted_key:
+                continue
+            if fallback is None:
+                fallback = key
+            # a file over its share recycles its own blocks first
+            if self.file_bytes[inserting_file] > fair_share:
+                if key[0] == inserting_file:
+                    return key
+            elif self.file_bytes[key[0]] > fair_share:
+                return key
+        return fallback
+
+    def _remove(self, key):
+        block = self.blocks.pop(key)
+        file = key[0]
+        self.file_bytes[file] -= len(block)
+        if self.file_bytes[file] <= 0:
+            del self.file_bytes[file]
+        self.current_bytes -= len(block)
+        logging.debug(f"Evicted block {key[1]} of {file} from cache")
+
+class DiskCache:
+    """
+    Persistent, size capped chunk store used as a second tier below the BlockCache.
+
+    Every file gets its own directory holding one file per cached chunk. The least
+    recently used order is kept in memory and rebuilt from modification times on
+    startup, so cached chunks survive restarts. A chunk's modification time is only
+    updated when it is mapped, and recently read chunks stay mapped, so reads don't
+    write to the disk.
+
+    At most max_pending_writes chunks wait to be written, chunks arriving beyond that are
+    dropped so a slow disk can't grow memory. It should fit every block fetched at once.
+    """
+    def __init__(self, path: str, max_bytes: int, max_pending_writes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.chunks = OrderedDict()
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="diskcache")
+        self.pending_writes = threading.BoundedSemaphore(max_pending_writes)
+        self.writing = set()
+        self.maps = OrderedDict()
+        self.maps_lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dropped_writes = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self._loadIndex()
+
+    def _chunkPath(self, key):
+        return os.path.join(self.path, key[0], f"{key[1]}.chunk")
+
+    def _loadIndex(self):
+        found = []
+        for file_entry in os.scandir(self.path):
+            try:
+                if not file_entry.is_dir(follow_symlinks=False):
+                    continue
+                chunk_entries = list(os.scandir(file_entry.path))
+            except OSError as e:
+                logging.warning(f"Skipping {file_entry.path} in disk cache: {e}")
+                continue
+            for chunk_entry in chunk_entries:
+                # anything not written by this cache is left alone
+                if not chunk_entry.name.endswith(".chunk.tmp") and not chunk_entry.name.endswith(".chunk"):
+                    continue
+                name = chunk_entry.name.split(".", 1)[0]
+                if not name.isdigit():
+                    continue
+                try:
+                    if not chunk_entry.is_file(follow_symlinks=False):
+                        continue
+                    if chunk_entry.name.endswith(".tmp"):
+                        # leftover temporary files from an interrupted write
+                        os.remove(chunk_entry.path)
+                        continue
+                    stat_result = chunk_entry.stat()
+                except OSError as e:
+                    logging.warning(f"Skipping {chunk_entry.path} in disk cache: {e}")
+                    continue
+                found.append((stat_result.st_mtime, (file_entry.name, int(name)), stat_result.st_size))
+        for _, key, size in sorted(found):
+            self.chunks[key] = size
+            self.current_bytes += size
+        logging.info(f"Loaded {len(self.chunks)} chunks ({self.current_bytes // (1024 * 1024)}MB) from disk cache")
+        with self.lock:
+            self._evict()
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.chunks
+
+    def read(self, key, start: int, end: int):
+        """
+        Returns bytes start to end of a cached chunk, or None if the chunk is not cached.
+        """
+        with self.lock:
+            if key not in self.chunks:
+                self.misses += 1
+                return None
+            self.chunks.move_to_end(key)
+            self.hits += 1
+        try:
+            with self.maps_lock:
+                mm = self.maps.get(key)
+                if mm is None:
+                    mm = self._map(key)
+                else:
+                    self.maps.move_to_end(key)
+                # copied under the lock, so the map can't be closed halfway
+                return mm[start:end]
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading chunk {key} from disk cache: {e}")
+            with self.lock:
+                self._remove(key)
+            return None
+
+    def _map(self, key):
+        """
+        Maps a chunk and keeps it mapped, unmapping the least recently read chunk if too many are.
+        Mapping a chunk is what marks it as recently used for the next start.
+        """
+        chunk_path = self._chunkPath(key)
+        with open(chunk_path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        os.utime(chunk_path)
+        self.maps[key] = mm
+        while len(self.maps) > DISK_CACHE_OPEN_CHUNKS:
+            _, oldest = self.maps.popitem(last=False)
+            oldest.close()
+        return mm
+
+    def _unmap(self, key):
+        with self.maps_lock:
+            mm = self.maps.pop(key, None)
+            if mm is not None:
+                mm.close()
+
+    def put(self, key, chunk, size: int):
+        """
+        Queues a chunk to be written to disk, dropping it if too many writes are waiting already.
+        Chunks that aren't size bytes long are refused, they would be served as a truncated file after every restart.
+        """
+        if len(chunk) != size:
+            logging.warning(f"Not caching chunk {key} of {len(chunk)} bytes, expected {size} bytes")
+            return
+        with self.lock:
+            if key in self.chunks or key in self.writing:
+                return
+            if not self.pending_writes.acquire(blocking=False):
+                self.dropped_writes += 1
+                return
+            self.writing.add(key)
+        self.writer.submit(self._write, key, chunk)
+
+    def _write(self, key, chunk):
+        chunk_path = self._chunkPath(key)
+        temp_path = f"{chunk_path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+            with open(temp_path, "wb") as f:
+                f.write(chunk)
+            os.replace(temp_path, chunk_path)
+        except OSError as e:
+            logging.error(f"Error writing chunk {key} to disk cache: {e}")
+            return
+        finally:
+            with self.lock:
+                self.writing.discard(key)
+            self.pending_writes.release()
+        with self.lock:
+            if key not in self.chunks:
+                self.chunks[key] = len(chunk)
+                self.current_bytes += len(chunk)
+            self._evict()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "dropped_writes": self.dropped_writes,
+                "chunks": len(self.chunks),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self.chunks:
+            self._remove(next(iter(self.chunks)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        self.current_bytes -= self.chunks.pop(key, 0)
+        self._unmap(key)
+        chunk_path = self._chunkPath(key)
+        try:
+            os.remove(chunk_path)
+            os.rmdir(os.path.dirname(chunk_path))
+        except OSError:
+            # the directory still holds other chunks of the file
+            pass
@@ -1,14 +1,243 @@
-from tinydb import TinyDB
+from tinydb import TinyDB, where
+from contextlib import contextmanager
+from tinydb.operations import delete
+from library.app import DATABASE_BACKEND, DATABASE_PATH, DATABASE_BATCH_SIZE, DATABASE_BATCH_INTERVAL, DatabaseBackends
+from functions.recordFunctions import FileRecord
 import threading
+import asyncio
 import logging
+import sqlite3
+import queue
+import time
+import json
+import os
+
+VALUES_CHUNK_SIZE = 500
+SQLITE_IDLE_CONNECTIONS = 4 # connections kept open per table between operations
 
 db_connections = {}
 db_locks = {}
 global_lock = threading.Lock()
 
+class TinyDBStorage:
+    """
+    Stores records, and values by key, in a `<name>.json` file. Every write rewrites the whole file.
+    Records carry the generation they were added and retired in, like the SQLite storage.
+    """
+    concurrent_reads = False
+
+    def __init__(self, name: str):
+        self.db = TinyDB(f"{name}.json")
+        self.meta = self.db.table("meta")
+
+    def current_generation(self):
+        document = self.meta.get(where("key") == "generation")
+        return document.get("value") if document else 0
+
+    def begin_generation(self):
+        current = self.current_generation()
+        # drop what an unpublished refresh left behind
+        self.db.remove(where("_born") > current)
+        self.db.update(delete("_retired"), where("_retired") > current)
+        return current + 1
+
+    def publish_generation(self, generation: int):
+        self.meta.upsert({"key": "generation", "value": generation}, where("key") == "generation")
+        self.db.remove(where("_retired") <= generation)
+
+    def insert_multiple(self, records: list, generation: int | None = None):
+        born = self.current_generation() if generation is None else generation
+        self.db.insert_multiple([dict(record, _born=born) for record in records])
+
+    def all(self):
+        current = self.current_generation()
+        return [
+            {key: value for key, value in document.items() if key not in ("_born", "_retired")}
+            for document in self.db.all()
+            if document.get("_born", 0) <= current and document.get("_retired", current + 1) > current
+        ]
+
+    def retire_items(self, item_ids: list, generation: int):
+        self.db.update({"_retired": generation}, where("item_id").one_of(item_ids) & ~where("_retired").exists() & ~(where("_born") == generation))
+
+    def get_value(self, key: str):
+        document = self.db.table("values").get(where("key") == key)
+        if document is None:
+            return None
+        return document.get("value"), document.get("expires")
+
+    def set_value(self, key: str, value, expires: float):
+        self.db.table("values").upsert({"key": key, "value": value, "expires": expires}, where("key") == key)
+
+    def get_values(self, keys: list):
+        wanted = set(keys)
+        return {document["key"]: (document.get("value"), document.get("expires")) for document in self.db.table("values").all() if document.get("key") in wanted}
+
+    def set_values(self, values: dict, expires: float):
+        # replaced in two writes, since every write rewrites the whole file
+        table = self.db.table("values")
+        table.remove(where("key").test(lambda key: key in values))
+        table.insert_multiple([{"key": key, "value": value, "expires": expires} for key, value in values.items()])
+
+    def close(self):
+        self.db.close()
+
+class SQLiteStorage:
+    """
+    Stores records in a table of a SQLite database in WAL mode, with indexed item, file and folder hash columns,
+    and values by key in a second table. Every operation checks out a connection of its own from a small pool,
+    so reads don't wait for writes, and the connections of threads that come and go are reused instead of piling up.
+
+    Every record holds the generation it was added in and the one it was retired in. Readers only see the records
+    of the published generation, so a refresh builds the next generation next to it and publishes it in one transaction.
+    """
+    concurrent_reads = True
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        self.idle_connections = []
+        self.connections_lock = threading.Lock()
+
+        with self._connection() as connection, connection:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS "{name}" (id INTEGER PRIMARY KEY, item_id, file_id, folder_hash, data TEXT NOT NULL)')
+            for column in ("item_id", "file_id", "folder_hash"):
+                connection.execute(f'CREATE INDEX IF NOT EXISTS "{name}_{column}" ON "{name}" ({column})')
+            connection.execute(f'CREATE TABLE IF NOT EXISTS "{name}_values" (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)')
+            connection.execute(f'CREATE TABLE IF NOT EXISTS "{name}_meta" (key TEXT PRIMARY KEY, value NOT NULL)')
+            connection.execute(f'INSERT OR IGNORE INTO "{name}_meta" (key, value) VALUES (\'generation\', 0)')
+            columns = [row[1] for row in connection.execute(f'PRAGMA table_info("{name}")')]
+            if "born" not in columns:
+                # tables from before generations, their records belong to the first one
+                connection.execute(f'ALTER TABLE "{name}" ADD COLUMN born INTEGER NOT NULL DEFAULT 0')
+                connection.execute(f'ALTER TABLE "{name}" ADD COLUMN retired INTEGER')
+        self._migrateTinyDB()
+
+    @contextmanager
+    def _connection(self):
+        """
+        Checks out an idle connection, opening a new one if there is none, and returns it to the pool afterwards.
+        Connections beyond the ones kept idle are closed once they are returned.
+        """
+        with self.connections_lock:
+            connection = self.idle_connections.pop() if self.idle_connections else None
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+        try:
+            yield connection
+        finally:
+            with self.connections_lock:
+                if len(self.idle_connections) < SQLITE_IDLE_CONNECTIONS:
+                    self.idle_connections.append(connection)
+                    connection = None
+            if connection is not None:
+                connection.close()
+
+    def _migrateTinyDB(self):
+        """
+        Imports the records of an existing TinyDB file into an empty table, then renames the file so it is only imported once.
+        """
+        json_path = f"{self.name}.json"
+        if not os.path.exists(json_path):
+            return
+        with self._connection() as connection:
+            if connection.execute(f'SELECT 1 FROM "{self.name}" LIMIT 1').fetchone():
+                return
+        tinydb = TinyDB(json_path)
+        records = tinydb.all()
+        tinydb.close()
+        self.insert_multiple(records)
+        os.replace(json_path, f"{json_path}.migrated")
+        logging.info(f"Migrated {len(records)} records from {json_path} to SQLite.")
+
+    def _current_generation(self, connection: sqlite3.Connection):
+        return connection.execute(f'SELECT value FROM "{self.name}_meta" WHERE key = \'generation\'').fetchone()[0]
+
+    def current_generation(self):
+        with self._connection() as connection:
+            return self._current_generation(connection)
+
+    def begin_generation(self):
+        with self._connection() as connection, connection:
+            current = self._current_generation(connection)
+            # drop what an unpublished refresh left behind
+            connection.execute(f'DELETE FROM "{self.name}" WHERE born > ?', (current,))
+            connection.execute(f'UPDATE "{self.name}" SET retired = NULL WHERE retired > ?', (current,))
+        return current + 1
+
+    def publish_generation(self, generation: int):
+        with self._connection() as connection, connection:
+            connection.execute(f'UPDATE "{self.name}_meta" SET value = ? WHERE key = \'generation\'', (generation,))
+            connection.execute(f'DELETE FROM "{self.name}" WHERE retired <= ?', (generation,))
+
+    def insert_multiple(self, records: list, generation: int | None = None):
+        with self._connection() as connection, connection:
+            born = self._current_generation(connection) if generation is None else generation
+            connection.executemany(
+                f'INSERT INTO "{self.name}" (item_id, file_id, folder_hash, data, born) VALUES (?, ?, ?, ?, ?)',
+                [(record.get("item_id"), record.get("file_id"), record.get("folder_hash"), json.dumps(record), born) for record in records],
+            )
+
+    def all(self):
+        # a single statement, so it reads one consistent snapshot even while the next generation is written
+        with self._connection() as connection:
+            rows = connection.execute(
+                f'''SELECT data FROM "{self.name}", (SELECT value AS current FROM "{self.name}_meta" WHERE key = 'generation')
+                WHERE born <= current AND (retired IS NULL OR retired > current) ORDER BY id'''
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def retire_items(self, item_ids: list, generation: int):
+        with self._connection() as connection, connection:
+            connection.executemany(
+                f'UPDATE "{self.name}" SET retired = ? WHERE item_id = ? AND retired IS NULL AND born < ?',
+                [(generation, item_id, generation) for item_id in item_ids],
+            )
+
+    def get_value(self, key: str):
+        with self._connection() as connection:
+            row = connection.execute(f'SELECT value, expires FROM "{self.name}_values" WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set_value(self, key: str, value, expires: float):
+        with self._connection() as connection, connection:
+            connection.execute(f'INSERT OR REPLACE INTO "{self.name}_values" (key, value, expires) VALUES (?, ?, ?)', (key, json.dumps(value), expires))
+
+    def get_values(self, keys: list):
+        values = {}
+        with self._connection() as connection:
+            # chunked to stay under the limit of query parameters
+            for start in range(0, len(keys), VALUES_CHUNK_SIZE):
+                chunk = keys[start:start + VALUES_CHUNK_SIZE]
+                rows = connection.execute(f'SELECT key, value, expires FROM "{self.name}_values" WHERE key IN ({", ".join("?" * len(chunk))})', chunk)
+                values.update({key: (json.loads(value), expires) for key, value, expires in rows})
+        return values
+
+    def set_values(self, values: dict, expires: float):
+        with self._connection() as connection, connection:
+            connection.executemany(f'INSERT OR REPLACE INTO "{self.name}_values" (key, value, expires) VALUES (?, ?, ?)', [(key, json.dumps(value), expires) for key, value in values.items()])
+
+    def close(self):
+        with self.connections_lock:
+            for connection in self.idle_connections:
+                connection.close()
+            self.idle_connections.clear()
+
+def openStorage(name: str):
+    """
+    Opens the storage for a database using the configured backend.
+    """
+    if DATABASE_BACKEND == DatabaseBackends.tinydb.value:
+        return TinyDBStorage(name)
+    return SQLiteStorage(name, DATABASE_PATH)
+
 def getDatabase(name: str = "db"):
     """
-    Returns the TinyDB database instance with thread-safe storage.
+    Returns the database storage instance for the configured backend.
     Uses a connection pool pattern to avoid creating multiple connections.
     """
     global db_connections, db_locks # global cause I'm lazy
@@ -16,7 +245,7 @@ def getDatabase(name: str = "db"):
     with global_lock:
         if name not in db_connections:
             try:
-                db_connections[name] = TinyDB(f"{name}.json")
+                db_connections[name] = openStorage(name)
                 db_locks[name] = threading.Lock()
             except Exception as e:
                 logging.error(f"Error connecting to the database: {e}")
@@ -33,26 +262,63 @@ def getDatabaseLock(name: str = "db"):
     getDatabase(name)
     return db_locks.get(name)
 
-def clearDatabase(type: str):
+def getGeneration(type: str):
     """
-    Clears the entire database with thread safety.
+    Returns the published generation of records, which is 0 if no refresh was ever published.
     """
     db = getDatabase(type)
     db_lock = getDatabaseLock(type)
     
     if db is None or db_lock is None:
-        return False, "Database connection failed."
+        return None, False, "Database connection failed."
+    
+    try:
+        if db.concurrent_reads:
+            generation = db.current_generation()
+        else:
+            with db_lock:
+                generation = db.current_generation()
+        return generation, True, "Generation retrieved successfully."
+    except Exception as e:
+        return None, False, f"Error retrieving generation. {e}"
+
+def beginGeneration(type: str):
+    """
+    Starts building the next generation of records, discarding anything left over from one that was never published.
+    """
+    db = getDatabase(type)
+    db_lock = getDatabaseLock(type)
+    
+    if db is None or db_lock is None:
+        return None, False, "Database connection failed."
     
     with db_lock:
         try:
-            db.truncate()
-            return True, "Database cleared successfully."
+            return db.begin_generation(), True, "Generation started successfully."
         except Exception as e:
-            return False, f"Error clearing the database: {e}"
+            return None, False, f"Error starting generation. {e}"
+
+def publishGeneration(type: str, generation: int):
+    """
+    Makes a generation the one readers see, all at once, and drops the records it retired.
+    """
+    db = getDatabase(type)
+    db_lock = getDatabaseLock(type)
+    
+    if db is None or db_lock is None:
+        return False, "Database connection failed."
     
-def insertData(data: dict, type: str):
+    with db_lock:
+        try:
+            db.publish_generation(generation)
+            return True, "Generation published successfully."
+        except Exception as e:
+            return False, f"Error publishing generation. {e}"
+
+def insertMany(data: list, type: str, generation: int | None = None):
     """
-    Inserts data into the database with thread safety.
+    Inserts multiple records into the database in a single transaction with thread safety.
+    The records are added to the given generation, or to the published one if none is given.
     """
     db = getDatabase(type)
     db_lock = getDatabaseLock(type)
@@ -62,14 +328,105 @@ def insertData(data: dict, type: str):
     
     with db_lock:
         try:
-            db.insert(data)
+            db.insert_multiple([record.toDict() for record in data], generation)
             return True, "Data inserted successfully."
         except Exception as e:
             return False, f"Error inserting data. {e}"
+
+class BatchWriter:
+    """
+    Collects records from any thread and writes them with insertMany on a single writer thread,
+    committing whenever a batch is full or the batch interval has passed.
+    """
+    def __init__(self, type: str, batch_size: int = DATABASE_BATCH_SIZE, batch_interval: float = DATABASE_BATCH_INTERVAL, generation: int | None = None):
+        self.type = type
+        self.generation = generation
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.records = queue.Queue()
+        self.written = 0
+        self.failed = 0
+        self.started = time.time()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, data: FileRecord):
+        self.records.put(data)
+
+    def close(self):
+        """
+        Writes the remaining records, waits for the writer thread and logs the throughput.
+        """
+        self.records.put(None)
+        self.thread.join()
+        elapsed = time.time() - self.started
+        rate = self.written / elapsed if elapsed > 0 else 0
+        logging.info(f"Wrote {self.written} {self.type} records in {elapsed:.2f} seconds ({rate:.0f} records/s).")
+        if self.failed:
+            logging.error(f"Failed to write {self.failed} {self.type} records.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        # waiting for the last batch happens off the event loop, so other syncs keep running
+        await asyncio.to_thread(self.close)
+
+    def _run(self):
+        batch = []
+        deadline = time.time() + self.batch_interval
+        while True:
+            try:
+                data = self.records.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                data = False
+            if data:
+                batch.append(data)
+            if data is None or len(batch) >= self.batch_size or time.time() >= deadline:
+                self._write(batch)
+                batch = []
+                deadline = time.time() + self.batch_interval
+            if data is None:
+                return
+
+    def _write(self, batch: list):
+        if not batch:
+            return
+        success, detail = insertMany(batch, self.type, self.generation)
+        if success:
+            self.written += len(batch)
+        else:
+            self.failed += len(batch)
+            logging.error(f"Error writing {len(batch)} {self.type} records: {detail}")
+
+def deleteData(item_ids: list, type: str, generation: int):
+    """
+    Deletes all records belonging to the given items from a generation with thread safety.
+    The records are only retired from it, and stay visible until it is published.
+    """
+    db = getDatabase(type)
+    db_lock = getDatabaseLock(type)
+    
+    if db is None or db_lock is None:
+        return False, "Database connection failed."
+    
+    with db_lock:
+        try:
+            db.retire_items(item_ids, generation)
+            return True, "Data deleted successfully."
+        except Exception as e:
+            return False, f"Error deleting data. {e}"
     
 def getAllData(type: str):
     """
-    Retrieves all data from the database with thread safety.
+    Retrieves all records of the published generation from the database with thread safety.
+    Never sees a generation that is still being built.
     """
     db = getDatabase(type)
     db_lock = getDatabaseLock(type)
@@ -77,12 +434,94 @@ def getAllData(type: str):
     if db is None or db_lock is None:
         return None, False, "Database connection failed."
     
+    try:
+        if db.concurrent_reads:
+            data = db.all()
+        else:
+            with db_lock:
+                data = db.all()
+        return [FileRecord.fromDict(record) for record in data], True, "Data retrieved successfully."
+    except Exception as e:
+        return None, False, f"Error retrieving data. {e}"
+
+def getValue(key: str, name: str):
+    """
+    Retrieves a value stored by key, returning None if it is missing or expired.
+    """
+    db = getDatabase(name)
+    db_lock = getDatabaseLock(name)
+    
+    if db is None or db_lock is None:
+        return None
+    
+    try:
+        if db.concurrent_reads:
+            entry = db.get_value(key)
+        else:
+            with db_lock:
+                entry = db.get_value(key)
+    except Exception as e:
+        logging.error(f"Error retrieving value {key}: {e}")
+        return None
+    if entry is None or entry[1] < time.time():
+        return None
+    return entry[0]
+
+def setValue(key: str, value, ttl: float, name: str):
+    """
+    Stores a value by key for ttl seconds with thread safety.
+    """
+    db = getDatabase(name)
+    db_lock = getDatabaseLock(name)
+    
+    if db is None or db_lock is None:
+        return False, "Database connection failed."
+    
     with db_lock:
         try:
-            data = db.all()
-            return data, True, "Data retrieved successfully."
+            db.set_value(key, value, time.time() + ttl)
+            return True, "Value stored successfully."
+        except Exception as e:
+            return False, f"Error storing value. {e}"
+
+def getValues(keys: list, name: str):
+    """
+    Retrieves the values stored by a list of keys at once, returning a dict of the ones that are present and not expired.
+    """
+    db = getDatabase(name)
+    db_lock = getDatabaseLock(name)
+    
+    if db is None or db_lock is None:
+        return {}
+    
+    try:
+        if db.concurrent_reads:
+            entries = db.get_values(keys)
+        else:
+            with db_lock:
+                entries = db.get_values(keys)
+    except Exception as e:
+        logging.error(f"Error retrieving values: {e}")
+        return {}
+    now = time.time()
+    return {key: value for key, (value, expires) in entries.items() if expires >= now}
+
+def setValues(values: dict, ttl: float, name: str):
+    """
+    Stores a dict of values by key for ttl seconds in a single write with thread safety.
+    """
+    db = getDatabase(name)
+    db_lock = getDatabaseLock(name)
+    
+    if db is None or db_lock is None:
+        return False, "Database connection failed."
+    
+    with db_lock:
+        try:
+            db.set_values(values, time.time() + ttl)
+            return True, "Values stored successfully."
         except Exception as e:
-            return None, False, f"Error retrieving data. {e}"
+            return False, f"Error storing values. {e}"
 
 def closeDatabase(name: str = "db"):
     """
@@ -1,13 +1,20 @@
 from library.app import RAW_MODE
 import os
-from library.filesystem import MOUNT_PATH
+from library.filesystem import MOUNT_PATH, FUSE_CACHE_SIZE, FUSE_READAHEAD_BLOCKS, FUSE_READAHEAD_WORKERS, FUSE_DISK_CACHE_PATH, FUSE_DISK_CACHE_SIZE, FUSE_MULTITHREADED, FUSE_ATTR_TIMEOUT, FUSE_KERNEL_CACHE
 import stat
 import errno
 from functions.torboxFunctions import getDownloadLink, downloadFile
 import time
 import sys
+import math
+import hashlib
+import bisect
+from datetime import datetime
 import logging
-from functions.appFunctions import getAllUserDownloads
+from functions.appFunctions import getAllUserDownloads, getPublishedGenerations
+from functions.cacheFunctions import BlockCache, DiskCache, SingleFlight
+from library.ratelimit import limiterStats
+from functions.readaheadFunctions import ReadAhead, StreamState
 import threading
 from sys import platform
 
@@ -24,88 +31,239 @@ if not hasattr(fuse, '__version__'):
 fuse.fuse_python_api = (0, 2)
 
 LINK_AGE = 3 * 60 * 60 # 3 hours
+FILES_RELOAD_INTERVAL = 300 # seconds between reloads of the stored files when no refresh signals one
+
+files_refreshed = threading.Event()
+
+class FuseStat(fuse.Stat):
+    def __init__(self, st_mode=0, st_ino=0, st_nlink=0, st_uid=0, st_gid=0, st_size=0, st_atime=0, st_mtime=0, st_ctime=0):
+        self.st_mode = st_mode
+        self.st_ino = st_ino
+        self.st_dev = 0
+        self.st_nlink = st_nlink
+        self.st_uid = st_uid
+        self.st_gid = st_gid
+        self.st_size = st_size
+        self.st_atime = st_atime
+        self.st_mtime = st_mtime
+        self.st_ctime = st_ctime
+
+def fileKey(f):
+    """
+    Returns the identity of a download file, which stays the same when its path changes.
+    """
+    return f"{f.type}-{f.item_id}-{f.file_id}"
+
+def stableInode(key: str):
+    """
+    Returns an inode number derived from a key, so it stays the same across VFS rebuilds and restarts.
+    """
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return (int.from_bytes(digest, "big") >> 1) or 1
+
+def parseTimestamp(value):
+    """
+    Converts an ISO 8601 timestamp from the API to a unix timestamp, returning 0 if it is missing or invalid.
+    """
+    if not value:
+        return 0
+    try:
+        return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp())
+    except (ValueError, AttributeError):
+        return 0
 
 class VirtualFileSystem:
-    def __init__(self, files_list):
-        self.files = files_list
-        self.structure = self._build_structure()
-        self.file_map = self._build_file_map()
+    """
+    Index of the mounted paths, keyed by file identity.
 
-    def _build_structure(self):
+    A VFS is never modified once it is in use. `update` returns a new VFS that shares every
+    unchanged entry with the old one and only rebuilds the paths, directory listings and
+    stat records touched by added, removed or renamed files, so it can be swapped in with
+    a single assignment.
+    """
+    def __init__(self, files_list=None):
+        self.entries = {} # file key -> (path, file)
+        self.file_map = {} # path -> file
+        self.path_keys = {} # path -> keys of the files mapped to the path
+        self.structure = {} # directory path -> sorted names
+        self.stats = {} # path -> FuseStat
+        self._owned = set()
+        self._dirty = set()
         if RAW_MODE:
-            structure = { '/': set() }
-            for f in self.files:
-                original_path = f.get("path")
-                if original_path:
-                    # Split the path into parts
-                    parts = original_path.split('/')
-                    current_path = '/'
-                    for part in parts[:-1]:  # Skip the filename
-                        if part not in structure.get(current_path, set()):
-                            structure.setdefault(current_path, set()).add(part)
-                            current_path = f"{current_path}{part}/"
-                            structure.setdefault(current_path, set())
-            # Ensure consistent ordering
-            for key in structure:
-                structure[key] = sorted([item for item in structure[key] if item is not None])
-            return structure
+            self.roots = ('/',)
+            self.structure['/'] = []
         else:
-            structure = {
-                '/': ['movies', 'series'],
-                '/movies': set(),
-                '/series': set()
-            }
-        
-        
-        for f in self.files:
-            media_type = f.get('metadata_mediatype')
-            root_folder = f.get('metadata_rootfoldername')
-            
-            if media_type == 'movie':
-                path = f'/movies/{root_folder}'
-                structure['/movies'].add(root_folder)
-                
-                if path not in structure:
-                    structure[path] = set()
-                structure[path].add(f.get('metadata_filename'))
-                
-            elif media_type == 'series':
-                path = f'/series/{root_folder}'
-                structure['/series'].add(root_folder)
-                
-                if path not in structure:
-                    structure[path] = set()
-                structure[path].add(f.get('metadata_foldername'))
-                
-                season_path = f'{path}/{f.get("metadata_foldername")}'
-                if season_path not in structure:
-                    structure[season_path] = set()
-                structure[season_path].add(f.get('metadata_filename'))
-        
-        # consistent ordering
-        for key in structure:
-            structure[key] = sorted([item for item in structure[key] if item is not None])
-            
-        return structure
+            self.roots = ('/', '/movies', '/series')
+            self.structure['/'] = ['movies', 'series']
+            self.structure['/movies'] = []
+            self.structure['/series'] = []
+        self._dirty.update(self.roots)
+        self._apply(files_list or [])
 
-def _build_file_map(self):
-    file_map = {}
-    for f in self.files:
+    def _path(self, f):
         if RAW_MODE:
-            original_path = f.get("path")
-            if original_path:
-                path = f'/{original_path}'
-                file_map[path] = f
-        else:
-            if f.get('metadata_mediatype') == 'movie':
-                path = f'/movies/{f.get("metadata_rootfoldername")}/{f.get("metadata_filename")}'
-                file_map[path] = f
-            else:  # series
-                path = f'/series/{f.get("metadata_rootfoldername")}/{f.get("metadata_foldername")}/{f.get("metadata_filename")}'
-                file_map[path] = f
+            original_path = f.path
+            if not original_path:
+                return None
+            return f'/{original_path.strip("/")}'
+
+        root_folder = f.metadata_rootfoldername
+        file_name = f.metadata_filename
+        if not root_folder or not file_name:
+            return None
+        if f.metadata_mediatype == 'movie':
+            return f'/movies/{root_folder}/{file_name}'
+        elif f.metadata_mediatype in ('series', 'anime'):
+            folder_name = f.metadata_foldername
+            if not folder_name:
+                return None
+            return f'/series/{root_folder}/{folder_name}/{file_name}'
+        return None
+
+    def update(self, files_list):
+        """
+        Returns a new VFS holding files_list, reusing everything this VFS built for unchanged files.
+        """
+        new = VirtualFileSystem.__new__(VirtualFileSystem)
+        new.entries = dict(self.entries)
+        new.file_map = dict(self.file_map)
+        new.path_keys = dict(self.path_keys)
+        new.structure = dict(self.structure)
+        new.stats = dict(self.stats)
+        new.roots = self.roots
+        new._owned = set()
+        new._dirty = set()
+        new._apply(files_list)
+        return new
+
+    def _apply(self, files_list):
+        incoming = {fileKey(f): f for f in files_list}
 
-    return file_map
+        removed = [key for key in self.entries if key not in incoming]
+        for key in removed:
+            self._remove_file(key)
 
+        changed = 0
+        for key, f in incoming.items():
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] == f:
+                    continue
+                # changed or renamed, so it is re-added under its current path
+                self._remove_file(key)
+            self._add_file(key, f)
+            changed += 1
+
+        # directory times depend on their children, so parents are rebuilt after them
+        dirty = set()
+        for path in self._dirty:
+            while path not in dirty and path in self.structure:
+                dirty.add(path)
+                path = os.path.dirname(path)
+        for path in sorted(dirty, key=lambda path: len(path.rstrip('/').split('/')), reverse=True):
+            self.stats[path] = self._build_dir_stat(path)
+
+        self._owned = set()
+        self._dirty = set()
+        logging.debug(f"Applied {changed} new or changed and {len(removed)} removed files to VFS")
+
+    def _names(self, directory):
+        # listings can be shared with the previous VFS, so they are copied before their first change
+        if directory not in self._owned:
+            self.structure[directory] = list(self.structure.get(directory, []))
+            self._owned.add(directory)
+        self._dirty.add(directory)
+        return self.structure[directory]
+
+    def _add_file(self, key, f):
+        path = self._path(f)
+        if path is None:
+            return
+        self.entries[key] = (path, f)
+        self.path_keys[path] = self.path_keys.get(path, frozenset()) | {key}
+        self.file_map[path] = f
+        self.stats[path] = self._build_file_stat(key, f)
+
+        # add the path to its directory, creating missing parents on the way up
+        child = path
+        while child not in self.roots:
+            directory = os.path.dirname(child)
+            existed = directory in self.structure
+            names = self._names(directory)
+            name = os.path.basename(child)
+            index = bisect.bisect_left(names, name)
+            if index == len(names) or names[index] != name:
+                names.insert(index, name)
+            if existed:
+                break
+            child = directory
+
+    def _remove_file(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        path = entry[0]
+        keys = self.path_keys[path] - {key}
+        if keys:
+            # another file has the same path and takes its place
+            other_key = next(iter(keys))
+            self.path_keys[path] = keys
+            self.file_map[path] = self.entries[other_key][1]
+            self.stats[path] = self._build_file_stat(other_key, self.file_map[path])
+            self._dirty.add(os.path.dirname(path))
+            return
+        del self.path_keys[path]
+        del self.file_map[path]
+        del self.stats[path]
+
+        # remove the path from its directory, removing parents left empty on the way up
+        child = path
+        while child not in self.roots:
+            directory = os.path.dirname(child)
+            names = self._names(directory)
+            name = os.path.basename(child)
+            index = bisect.bisect_left(names, name)
+            if index < len(names) and names[index] == name:
+                names.pop(index)
+            if names or directory in self.roots:
+                break
+            del self.structure[directory]
+            self.stats.pop(directory, None)
+            self._owned.discard(directory)
+            self._dirty.discard(directory)
+            child = directory
+
+    def _build_file_stat(self, key, f):
+        mtime = parseTimestamp(f.created_at)
+        return FuseStat(
+            st_mode=stat.S_IFREG | 0o444,
+            st_ino=stableInode(key),
+            st_nlink=1,
+            st_uid=os.getuid(),
+            st_gid=os.getgid(),
+            st_size=f.file_size or 0,
+            st_atime=mtime,
+            st_mtime=mtime,
+            st_ctime=mtime,
+        )
+
+    def _build_dir_stat(self, path):
+        # a directory changes when its newest entry was added
+        mtime = 0
+        for name in self.structure[path]:
+            child_stat = self.stats.get(os.path.join(path, name))
+            if child_stat:
+                mtime = max(mtime, child_stat.st_mtime)
+        return FuseStat(
+            st_mode=stat.S_IFDIR | 0o755,
+            st_ino=stableInode(path),
+            st_nlink=2,
+            st_uid=os.getuid(),
+            st_gid=os.getgid(),
+            st_atime=mtime,
+            st_mtime=mtime,
+            st_ctime=mtime,
+        )
 
     def is_dir(self, path):
         return path in self.structure
@@ -118,87 +276,196 @@ def _build_file_map(self):
         
     def list_dir(self, path):
         return self.structure.get(path, [])
-    
-class FuseStat(fuse.Stat):
-    def __init__(self):
-        self.st_mode = 0
-        self.st_ino = 0
-        self.st_dev = 0
-        self.st_nlink = 0
-        self.st_uid = 0
-        self.st_gid = 0
-        self.st_size = 0
-        self.st_atime = 0
-        self.st_mtime = 0
-        self.st_ctime = 0
 
+    def get_stat(self, path):
+        return self.stats.get(path)
+    
 class TorBoxMediaCenterFuse(Fuse):
     def __init__(self, *args, **kwargs):
         super(TorBoxMediaCenterFuse, self).__init__(*args, **kwargs)
 
-        threading.Thread(target=self.getFiles, daemon=True).start()
-
         self.files = []
         self.vfs = VirtualFileSystem(self.files)
+        self.generations = None # published generations the VFS was loaded from
         self.file_handles = {}
         self.next_handle = 1
+        self.handles_lock = threading.Lock()
         self.cached_links = {}
+        self.links_lock = threading.Lock()
+        self.link_requests = SingleFlight()
 
-        self.cache = {}
-        self.block_size = 1024 * 1024 * 64  # 64MB Blocks
-        self.max_blocks = 64 # Max 64 blocks in cache (4GB)
+        self.block_size = 1024 * 1024 * 64  # 64MB Blocks, the largest range fetched at once
+        self.chunk_size = 1024 * 1024 # 1MB Chunks, the smallest range fetched and cached
+        self.cache = BlockCache(FUSE_CACHE_SIZE * 1024 * 1024)
+        # every read-ahead worker and a reader can each be writing a whole block of chunks at once
+        disk_cache_writes = (FUSE_READAHEAD_WORKERS + 1) * self.block_size // self.chunk_size
+        self.disk_cache = DiskCache(FUSE_DISK_CACHE_PATH, FUSE_DISK_CACHE_SIZE * 1024 * 1024, disk_cache_writes) if FUSE_DISK_CACHE_PATH else None
+        self.chunk_requests = SingleFlight()
+        self.readahead = ReadAhead(self.prefetchBlock, self.block_size, self.chunk_size, FUSE_READAHEAD_BLOCKS, FUSE_READAHEAD_WORKERS)
+
+        # loaded before mounting, so the stored library is there from the start instead of showing up empty
+        self.loadFiles()
+        threading.Thread(target=self.getFiles, daemon=True).start()
 
     def getFiles(self):
         while True:
-            files = getAllUserDownloads()
-            if files:
+            files_refreshed.wait(FILES_RELOAD_INTERVAL)
+            self.loadFiles()
+
+    def loadFiles(self):
+        # cleared before reading, so a refresh finishing while the files are read triggers another reload
+        files_refreshed.clear()
+        # read before the files, so a refresh published in between is picked up by the next reload
+        generations = getPublishedGenerations()
+        if generations is not None and generations == self.generations:
+            logging.debug("No refresh was published since the last reload, keeping the VFS as it is")
+        else:
+            files, success = getAllUserDownloads()
+            if success:
+                # the new VFS is built aside and swapped in with a single assignment, readers keep the one they started with
                 self.files = files
-                self.vfs = VirtualFileSystem(self.files)
+                old_vfs = self.vfs
+                self.vfs = old_vfs.update(files)
+                self.generations = generations
+                self.dropRemovedFiles(old_vfs, self.vfs)
                 logging.debug(f"Updated {len(self.files)} files in VFS")
-            time.sleep(300)
+        logging.debug(f"Block cache stats: {self.cache.stats()}")
+        if self.disk_cache:
+            logging.debug(f"Disk cache stats: {self.disk_cache.stats()}")
+        logging.debug(f"Rate limiter stats: {limiterStats()}")
         
     def getattr(self, path):
-        st = FuseStat()
-        now = int(time.time())
-        st.st_atime = now
-        st.st_mtime = now
-        st.st_ctime = now
-        
-        st.st_uid = os.getuid()
-        st.st_gid = os.getgid()
-        
-        if self.vfs.is_dir(path):
-            st.st_mode = stat.S_IFDIR | 0o755
-            st.st_nlink = 2
-            return st
-        elif self.vfs.is_file(path):
-            file_info = self.vfs.get_file(path)
-            if not file_info:
-                return -errno.ENOENT
-            st.st_mode = stat.S_IFREG | 0o444
-            st.st_nlink = 1
-            st.st_size = file_info.get('file_size', 0)
-            return st
-            
-        # Not found
-        return -errno.ENOENT
+        st = self.vfs.get_stat(path)
+        if st is None:
+            return -errno.ENOENT
+        return st
     
     def readdir(self, path, _):
-        if not self.vfs.is_dir(path):
+        vfs = self.vfs
+        if not vfs.is_dir(path):
             return -errno.ENOENT
             
-        yield fuse.Direntry('.')
-        yield fuse.Direntry('..')
+        # with use_ino the kernel takes the inode of every entry from here, and entries with inode 0 are hidden
+        yield self.direntry('.', vfs.get_stat(path))
+        yield self.direntry('..', vfs.get_stat(os.path.dirname(path)) or vfs.get_stat(path))
         
-        for item in self.vfs.list_dir(path):
-            yield fuse.Direntry(item)
+        for item in vfs.list_dir(path):
+            entry_stat = vfs.get_stat(os.path.join(path, item))
+            if entry_stat is not None:
+                yield self.direntry(item, entry_stat)
+
+    def direntry(self, name, entry_stat):
+        return fuse.Direntry(name, ino=entry_stat.st_ino, type=stat.S_IFMT(entry_stat.st_mode))
     
-    def open(self, _, flags):
+    def open(self, path, flags):
         accmode = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
         if (flags & accmode) != os.O_RDONLY:
             return -errno.EACCES
+        with self.handles_lock:
+            stream = self.readahead.openStream(self.next_handle, path)
+            self.next_handle += 1
+            self.file_handles[stream.handle] = stream
+        return stream
+
+    def dropRemovedFiles(self, old_vfs, new_vfs):
+        """
+        Drops the cached blocks and links of files that are no longer in the VFS, so nothing of them outlives their removal.
+        """
+        removed = [key for key in old_vfs.entries if key not in new_vfs.entries]
+        with self.links_lock:
+            for key in removed:
+                self.cached_links.pop(key, None)
+        for key in removed:
+            self.cache.invalidate(key)
+        if removed:
+            logging.debug(f"Dropped cached state of {len(removed)} removed files")
+
+    def getCachedLink(self, file):
+        key = fileKey(file)
+        with self.links_lock:
+            cached_link = self.cached_links.get(key)
+        if cached_link and time.time() - cached_link['timestamp'] <= LINK_AGE:
+            return cached_link['link']
+        return self.link_requests.do([key], self.resolveLink, key, file)
+
+    def resolveLink(self, key, file):
+        download_link = getDownloadLink(file.download_link)
+        with self.links_lock:
+            self.cached_links[key] = {
+                'link': download_link,
+                'timestamp': time.time()
+            }
+        return download_link
+
+    def chunkKey(self, file, chunk_index):
+        """
+        Returns the cache key for a chunk, based on the file identity rather than its path, so it survives renames
+        and a path taken over by another file never serves the chunks of the previous one.
+        """
+        return (fileKey(file), chunk_index)
+
+    def isCachedOrFetching(self, file, chunk_index):
+        key = self.chunkKey(file, chunk_index)
+        if self.cache.contains(key) or self.chunk_requests.inFlight(key):
+            return True
+        return bool(self.disk_cache) and self.disk_cache.contains(key)
+
+    def missingChunks(self, file, first_chunk, max_chunks, last_chunk):
+        """
+        Returns how many chunks starting at first_chunk can be fetched in one range, stopping at the first cached chunk.
+        """
+        count = 1
+        while count < max_chunks and first_chunk + count <= last_chunk and not self.isCachedOrFetching(file, first_chunk + count):
+            count += 1
+        return count
+
+    def fetchChunks(self, file, first_chunk, chunk_count):
+        """
+        Fetches a run of chunks, waiting for the fetch already in flight instead if the first chunk is being fetched.
+        """
+        keys = [self.chunkKey(file, first_chunk + i) for i in range(chunk_count)]
+        return self.chunk_requests.do(keys, self.downloadChunks, file, first_chunk, chunk_count)
+
+    def downloadChunks(self, file, first_chunk, chunk_count):
+        """
+        Downloads a run of chunks of a file in a single range request and stores them in the cache.
+        """
+        range_offset = first_chunk * self.chunk_size
+        range_size = min(chunk_count * self.chunk_size, file.file_size - range_offset)
+
+        download_link = self.getCachedLink(file)
+        started = time.time()
+        range_chunks = downloadFile(download_link, range_size, range_offset, self.chunk_size)
+        if not range_chunks:
+            return None
+        self.readahead.recordTransfer(sum(len(chunk) for chunk in range_chunks), time.time() - started)
+
+        chunks = {}
+        for i, chunk in enumerate(range_chunks):
+            chunks[first_chunk + i] = chunk
+            self.cache.put(self.chunkKey(file, first_chunk + i), chunk)
+            if self.disk_cache:
+                # only the last chunk of a file is shorter than chunk_size
+                chunk_offset = (first_chunk + i) * self.chunk_size
+                self.disk_cache.put(self.chunkKey(file, first_chunk + i), chunk, min(self.chunk_size, file.file_size - chunk_offset))
+        return chunks
+
+    def prefetchBlock(self, path, block_index):
+        file = self.vfs.get_file(path)
+        if not file:
+            return
+        chunks_per_block = self.block_size // self.chunk_size
+        chunk_index = block_index * chunks_per_block
+        last_chunk = min((block_index + 1) * chunks_per_block, math.ceil(file.file_size / self.chunk_size)) - 1
+        while chunk_index <= last_chunk:
+            if self.isCachedOrFetching(file, chunk_index):
+                chunk_index += 1
+                continue
+            chunk_count = self.missingChunks(file, chunk_index, last_chunk - chunk_index + 1, last_chunk)
+            self.fetchChunks(file, chunk_index, chunk_count)
+            chunk_index += chunk_count
     
-    def read(self, path, size, offset):
+    def read(self, path, size, offset, fh=None):
         logging.debug(f"READ Path: {path}")
         logging.debug(f"READ Size: {size}")
         logging.debug(f"READ Offset: {offset}")
@@ -206,58 +473,66 @@ class TorBoxMediaCenterFuse(Fuse):
 
         if not file:
             return -errno.ENOENT
+
+        file_size = file.file_size
+        if offset >= file_size:
+            return b""
+        size = min(size, file_size - offset)
+
+        stream = fh if isinstance(fh, StreamState) else None
+        if stream:
+            self.readahead.observe(stream, offset, size, file_size)
         
-        current_time = time.time()
-        if path not in self.cached_links:
-            self.cached_links[path] = {
-                'link': getDownloadLink(file.get('download_link')),
-                'timestamp': current_time
-            }
-        elif current_time - self.cached_links[path]['timestamp'] > LINK_AGE:
-            download_link = getDownloadLink(file.get('download_link'))
-            self.cached_links[path] = {
-                'link': download_link,
-                'timestamp': current_time
-            }
-        download_link = self.cached_links[path]['link']
-        
-        start_block = offset // self.block_size
-        end_block = (offset + size - 1) // self.block_size
+        start_chunk = offset // self.chunk_size
+        end_chunk = (offset + size - 1) // self.chunk_size
+        last_chunk = (file_size - 1) // self.chunk_size
         
-        buffer = bytearray()
+        # reads within one chunk are served as a slice of the chunk, larger reads are assembled in one buffer
+        single_chunk = start_chunk == end_chunk
+        buffer = None if single_chunk else memoryview(bytearray(size))
+        position = 0
+        fetched = {}
         
-        for block_index in range(start_block, end_block + 1):
-            block_offset = block_index * self.block_size
-            block_end = min((block_index + 1) * self.block_size - 1, file.get('file_size') - 1)
-            current_block_size = block_end - block_offset + 1
+        for chunk_index in range(start_chunk, end_chunk + 1):
+            chunk_offset = chunk_index * self.chunk_size
+            start_offset_in_chunk = max(0, offset - chunk_offset)
+            end_offset_in_chunk = min(self.chunk_size, offset + size - chunk_offset)
             
-            # check for block
-            if (path, block_index) not in self.cache:
-                logging.debug(f"Cache miss for block {block_index}, fetching...")
-                # get block
-                block_data = downloadFile(download_link, current_block_size, block_offset)
-                if not block_data:
+            # check for chunk
+            chunk_data = fetched.get(chunk_index) or self.cache.get(self.chunkKey(file, chunk_index))
+            if chunk_data is None and self.disk_cache:
+                # the disk cache relies on the page cache instead of filling the block cache
+                disk_data = self.disk_cache.read(self.chunkKey(file, chunk_index), start_offset_in_chunk, end_offset_in_chunk)
+                if disk_data is not None:
+                    if single_chunk:
+                        return disk_data
+                    buffer[position:position + len(disk_data)] = disk_data
+                    position += len(disk_data)
+                    continue
+            if chunk_data is None:
+                # fetch at least the rest of this read, more if the stream is sequential
+                max_chunks = max(end_chunk - chunk_index + 1, self.readahead.fetchSize(stream) // self.chunk_size)
+                chunk_count = self.missingChunks(file, chunk_index, max_chunks, last_chunk)
+                logging.debug(f"Cache miss for chunk {chunk_index}, fetching {chunk_count} chunks...")
+                chunks = self.fetchChunks(file, chunk_index, chunk_count)
+                if not chunks or chunk_index not in chunks:
                     return -errno.EIO
-                # save block to cache
-                self.cache[(path, block_index)] = block_data
-                # lru cache
-                if len(self.cache) > self.max_blocks * len(self.cached_links):
-                    keys_to_remove = list(self.cache.keys())[:len(self.cache) - self.max_blocks]
-                    for key in keys_to_remove:
-                        del self.cache[key]
-            # get block from cache
-            block_data = self.cache[(path, block_index)]
-            
-            start_offset_in_block = max(0, offset - block_offset)
-            end_offset_in_block = min(len(block_data), offset + size - block_offset)
+                fetched.update(chunks)
+                chunk_data = chunks[chunk_index]
             
-            buffer.extend(block_data[start_offset_in_block:end_offset_in_block])
+            chunk_slice = chunk_data[start_offset_in_chunk:end_offset_in_chunk]
+            if single_chunk:
+                return chunk_slice
+            buffer[position:position + len(chunk_slice)] = chunk_slice
+            position += len(chunk_slice)
         
-        return bytes(buffer)
+        return buffer[:position]
     
-    def release(self, _, fh):
-        if fh in self.file_handles:
-            del self.file_handles[fh]
+    def release(self, path, flags, fh=None):
+        if isinstance(fh, StreamState):
+            self.readahead.close(fh)
+            with self.handles_lock:
+                self.file_handles.pop(fh.handle, None)
         return 0
     
 def runFuse():
@@ -266,6 +541,8 @@ def runFuse():
         usage="%prog [options] mountpoint",
         dash_s_do="setsingle",
     )
+    # fuse-python serves every call on its own thread unless told otherwise, all shared state is locked for that
+    server.multithreaded = FUSE_MULTITHREADED
 
     server.parser.add_option(
         mountopt="root",
@@ -280,6 +557,20 @@ def runFuse():
     server.fuse_args.add(
         "allow_other"
     )
+    # paths, inodes and sizes only change on refreshes, so the kernel can answer repeated lookups itself
+    server.fuse_args.add(
+        "use_ino"
+    )
+    server.fuse_args.add(
+        "attr_timeout", str(FUSE_ATTR_TIMEOUT)
+    )
+    server.fuse_args.add(
+        "entry_timeout", str(FUSE_ATTR_TIMEOUT)
+    )
+    if FUSE_KERNEL_CACHE and platform != "darwin":
+        server.fuse_args.add(
+            "kernel_cache"
+        )
     server.fuse_args.add(
         "-f"
     )
@@ -291,6 +582,12 @@ def runFuse():
         sys.exit(1)
     server.main()
 
+def reloadFuse():
+    """
+    Makes the mount reload the stored files right away, for when a refresh finished.
+    """
+    files_refreshed.set()
+
 def unmountFuse():
     try:
         os.system("fusermount -u " + MOUNT_PATH)
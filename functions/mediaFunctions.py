@@ -45,6 +45,12 @@ def cleanTitle(title: str):
     title = re.sub(r"[\/\\\:\*\?\"\<\>\|]", "", title)
     return title
 
+def normalizeTitle(title: str):
+    """
+    Lowercases the title and collapses everything except letters and digits into single spaces, for comparing titles.
+    """
+    return re.sub(r"[\W_]+", " ", title.lower()).strip()
+
 def cleanYear(year: str | int):
     """
     Cleans the year listing which can be a string (2023-2024) or an int (2023).
@@ -0,0 +1,77 @@
+from concurrent.futures import ProcessPoolExecutor
+from importlib.metadata import version, PackageNotFoundError
+from library.app import PARSE_WORKERS
+from functions.databaseFunctions import getValues, setValues
+from functions.parseWorkerFunctions import parseNames
+import multiprocessing
+import threading
+import asyncio
+import logging
+
+PARSE_CACHE_NAME = "parse_cache"
+PARSE_CACHE_TTL = 90 * 24 * 60 * 60 # 90 days, a name always parses the same way
+PARSE_CHUNK_SIZE = 250 # names sent to a worker at once, so sending them costs little next to parsing them
+
+try:
+    # parsed titles are cached per version of the parser, so upgrading it parses every name again
+    PARSER_VERSION = version("parse-torrent-title")
+except PackageNotFoundError:
+    PARSER_VERSION = "unknown"
+
+parse_pool = None
+parse_pool_lock = threading.Lock()
+
+def getParsePool():
+    """
+    Returns the pool of worker processes names are parsed in, starting it on first use.
+    Workers are spawned rather than forked, so they don't inherit the locks held by the threads of the application.
+    """
+    global parse_pool
+    with parse_pool_lock:
+        if parse_pool is None:
+            parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return parse_pool
+
+def stopParsePool():
+    global parse_pool
+    with parse_pool_lock:
+        if parse_pool is not None:
+            parse_pool.shutdown(cancel_futures=True)
+            parse_pool = None
+
+async def parseUncached(names: list):
+    """
+    Parses names spread over the worker processes, or in a thread if there are too few to be worth sending to them.
+    """
+    if PARSE_WORKERS == 0 or len(names) <= PARSE_CHUNK_SIZE:
+        return await asyncio.to_thread(parseNames, names)
+    loop = asyncio.get_running_loop()
+    pool = getParsePool()
+    chunks = [names[start:start + PARSE_CHUNK_SIZE] for start in range(0, len(names), PARSE_CHUNK_SIZE)]
+    try:
+        results = await asyncio.gather(*[loop.run_in_executor(pool, parseNames, chunk) for chunk in chunks])
+    except Exception as e:
+        logging.error(f"Error parsing file names in worker processes, parsing them here instead: {e}")
+        stopParsePool()
+        return await asyncio.to_thread(parseNames, names)
+    return [title_data for chunk in results for title_data in chunk]
+
+async def parseTitles(names: list):
+    """
+    Returns the parsed titles of a list of file names by name.
+    Names parsed by an earlier refresh come from the parse cache, the rest are parsed in worker processes and added to it.
+    """
+    names = list(dict.fromkeys(names))
+    keys = {name: f"{PARSER_VERSION}|{name}" for name in names}
+    cached = await asyncio.to_thread(getValues, list(keys.values()), PARSE_CACHE_NAME)
+    titles = {name: cached[keys[name]] for name in names if keys[name] in cached}
+
+    uncached = [name for name in names if name not in titles]
+    if uncached:
+        parsed = dict(zip(uncached, await parseUncached(uncached)))
+        titles.update(parsed)
+        success, detail = await asyncio.to_thread(setValues, {keys[name]: title_data for name, title_data in parsed.items()}, PARSE_CACHE_TTL, PARSE_CACHE_NAME)
+        if not success:
+            logging.error(f"Error caching parsed titles: {detail}")
+    logging.debug(f"Parsed {len(uncached)} file names, {len(names) - len(uncached)} came from the parse cache")
+    return titles
@@ -0,0 +1,7 @@
+import PTN
+
+def parseNames(names: list):
+    """
+    Parses a list of file names. Runs in the parse worker processes, so this module imports nothing but the parser.
+    """
+    return [PTN.parse(name) for name in names]
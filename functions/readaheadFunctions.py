@@ -0,0 +1,142 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import logging
+import math
+import time
+
+SEQUENTIAL_SLACK = 1024 * 1024 * 2 # reads within 2MB of the last read still count as sequential
+FETCH_GROWTH = 4 # fetch size multiplier for each cache miss of a sequential stream
+
+class StreamState:
+    """
+    Access pattern state for a single open file.
+    """
+    def __init__(self, handle: int, path: str, fetch_size: int):
+        self.handle = handle
+        self.path = path
+        self.fetch_size = fetch_size
+        self.lock = threading.Lock()
+        self.last_end = None
+        self.sequential_reads = 0
+        self.sequential_bytes = 0
+        self.sequential_since = None
+        self.generation = 0
+        self.pending = {}
+
+    def consumptionRate(self):
+        """
+        Returns the rate in bytes per second the stream has been read at since it turned sequential.
+        """
+        if not self.sequential_since:
+            return 0.0
+        elapsed = time.time() - self.sequential_since
+        if elapsed <= 0:
+            return 0.0
+        return self.sequential_bytes / elapsed
+
+class ReadAhead:
+    """
+    Fetches blocks ahead of the playhead for sequentially read streams.
+
+    Cache misses of cold or random streams fetch small ranges, which grow towards whole
+    blocks as a stream turns sequential. Once a stream fetches whole blocks, the window
+    grows with the ratio between how fast it is consumed and how fast blocks can be
+    downloaded, and pending fetches are cancelled as soon as the stream seeks.
+    """
+    def __init__(self, fetch_block, block_size: int, min_fetch_size: int, max_blocks: int, workers: int):
+        self.fetch_block = fetch_block
+        self.block_size = block_size
+        self.min_fetch_size = min_fetch_size
+        self.max_blocks = max_blocks
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="readahead") if max_blocks > 0 else None
+        self.bandwidth = 0.0
+        self.bandwidth_lock = threading.Lock()
+
+    def recordTransfer(self, size: int, seconds: float):
+        """
+        Updates the observed download bandwidth with a finished transfer.
+        """
+        if seconds <= 0:
+            return
+        sample = size / seconds
+        with self.bandwidth_lock:
+            self.bandwidth = sample if not self.bandwidth else self.bandwidth * 0.7 + sample * 0.3
+
+    def openStream(self, handle: int, path: str):
+        return StreamState(handle, path, self.min_fetch_size)
+
+    def fetchSize(self, stream: StreamState | None):
+        """
+        Returns how many bytes to fetch on a cache miss, growing the size while the stream is sequential.
+        """
+        if stream is None:
+            return self.min_fetch_size
+        with stream.lock:
+            if stream.sequential_reads:
+                stream.fetch_size = min(stream.fetch_size * FETCH_GROWTH, self.block_size)
+            else:
+                stream.fetch_size = self.min_fetch_size
+            return stream.fetch_size
+
+    def window(self, stream: StreamState):
+        """
+        Returns how many blocks to keep fetched ahead of the stream.
+        """
+        if not self.bandwidth:
+            return 1
+        blocks = math.ceil(stream.consumptionRate() / self.bandwidth) + 1
+        return max(1, min(blocks, self.max_blocks))
+
+    def observe(self, stream: StreamState, offset: int, size: int, file_size: int):
+        """
+        Records a read on the stream and schedules read-ahead when the stream is sequential.
+        """
+        with stream.lock:
+            if stream.last_end is not None and abs(offset - stream.last_end) <= SEQUENTIAL_SLACK:
+                if not stream.sequential_reads:
+                    stream.sequential_since = time.time()
+                    stream.sequential_bytes = 0
+                stream.sequential_reads += 1
+                stream.sequential_bytes += size
+            else:
+                if stream.last_end is not None:
+                    logging.debug(f"Seek detected on {stream.path}, cancelling read-ahead")
+                self._cancel(stream)
+            stream.last_end = offset + size
+
+            # small probe reads never grow to whole blocks, so they don't trigger read-ahead
+            if not self.executor or stream.fetch_size < self.block_size:
+                return
+
+            current_block = (offset + size - 1) // self.block_size
+            last_block = (file_size - 1) // self.block_size
+            for block_index in range(current_block + 1, min(current_block + self.window(stream), last_block) + 1):
+                if block_index in stream.pending:
+                    continue
+                stream.pending[block_index] = self.executor.submit(self._prefetch, stream, stream.generation, block_index)
+
+    def close(self, stream: StreamState):
+        with stream.lock:
+            self._cancel(stream)
+
+    def _cancel(self, stream: StreamState):
+        stream.generation += 1
+        stream.sequential_reads = 0
+        stream.sequential_since = None
+        stream.fetch_size = self.min_fetch_size
+        for future in stream.pending.values():
+            future.cancel()
+        stream.pending.clear()
+
+    def _prefetch(self, stream: StreamState, generation: int, block_index: int):
+        try:
+            if stream.generation != generation:
+                return
+            logging.debug(f"Read-ahead fetching block {block_index} of {stream.path}")
+            self.fetch_block(stream.path, block_index)
+        except Exception as e:
+            logging.error(f"Error prefetching block {block_index} of {stream.path}: {e}")
+        finally:
+            with stream.lock:
+                if stream.generation == generation:
+                    stream.pending.pop(block_index, None)
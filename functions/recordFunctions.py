@@ -0,0 +1,97 @@
+from library.torbox import TORBOX_API_KEY
+from enum import Enum
+import sys
+import os
+
+class IDType(Enum):
+    torrents = "torrent_id"
+    usenet = "usenet_id"
+    webdl = "web_id"
+
+RECORD_FIELDS = (
+    "item_id",
+    "type",
+    "folder_name",
+    "folder_hash",
+    "file_id",
+    "file_name",
+    "file_size",
+    "file_mimetype",
+    "path",
+    "created_at",
+    "metadata_scanned",
+    "metadata_resolved",
+    "metadata_searched_at",
+    "metadata_title",
+    "metadata_link",
+    "metadata_mediatype",
+    "metadata_image",
+    "metadata_backdrop",
+    "metadata_years",
+    "metadata_season",
+    "metadata_episode",
+    "metadata_filename",
+    "metadata_rootfoldername",
+    "metadata_foldername",
+)
+
+# fields shared between the files of an item or a title, so one copy of each string is kept
+INTERNED_FIELDS = frozenset((
+    "type",
+    "folder_name",
+    "folder_hash",
+    "file_mimetype",
+    "created_at",
+    "metadata_title",
+    "metadata_link",
+    "metadata_mediatype",
+    "metadata_image",
+    "metadata_backdrop",
+    "metadata_rootfoldername",
+    "metadata_foldername",
+))
+
+class FileRecord:
+    """
+    A processed file of a download, as stored in the database and served by the mounts.
+
+    Slotted instead of a dict, with strings shared between files interned, and the download
+    link derived on demand so the API key isn't stored with every file.
+    """
+    __slots__ = RECORD_FIELDS
+
+    def __init__(self, **fields):
+        for name in RECORD_FIELDS:
+            value = fields.get(name)
+            if name in INTERNED_FIELDS and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, name, value)
+
+    @classmethod
+    def fromDict(cls, data: dict):
+        """
+        Builds a record from its stored form, ignoring fields that are no longer stored, like the old download links.
+        """
+        return cls(**data)
+
+    def toDict(self):
+        """
+        Returns the stored form of the record, leaving out empty fields.
+        """
+        return {name: getattr(self, name) for name in RECORD_FIELDS if getattr(self, name) is not None}
+
+    @property
+    def download_link(self):
+        return f"https://api.torbox.app/v1/api/{self.type}/requestdl?token={TORBOX_API_KEY}&{IDType[self.type].value}={self.item_id}&file_id={self.file_id}&redirect=true"
+
+    @property
+    def extension(self):
+        return os.path.splitext(self.file_name)[-1]
+
+    def __eq__(self, other):
+        if not isinstance(other, FileRecord):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in RECORD_FIELDS)
+
+    def __repr__(self):
+        return f"FileRecord({self.toDict()})"
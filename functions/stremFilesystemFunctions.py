@@ -1,40 +1,44 @@
 import os
-import glob
+import json
+import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from library.app import RAW_MODE
-from library.filesystem import MOUNT_PATH
+from library.filesystem import MOUNT_PATH, STRM_WORKERS, STRM_PROXY, STRM_MANIFEST_PATH
 from functions.appFunctions import getAllUserDownloads
+from functions.recordFunctions import FileRecord
+from functions.strmProxyFunctions import proxyUrl
 
-def generateFolderPath(data: dict) -> str | None:
+def generateFolderPath(data: FileRecord) -> str | None:
     """
     Takes in a user download and returns the folder path for the download.
     """
     
     if RAW_MODE:
-        original_path = data.get("path")
+        original_path = data.path
         if original_path:
             return os.path.dirname(original_path)
         return None
     else:
-      root_folder: str | None = data.get("metadata_rootfoldername", None)
-      metadata_foldername: str | None = data.get("metadata_foldername", None)
+      root_folder: str | None = data.metadata_rootfoldername
+      metadata_foldername: str | None = data.metadata_foldername
 
       if not root_folder:
           return None
 
-      if data.get("metadata_mediatype") == "series":
+      if data.metadata_mediatype == "series":
           if not metadata_foldername:
               return None
           folder_path = os.path.join(
               root_folder,
               metadata_foldername,
           )
-      elif data.get("metadata_mediatype") == "movie":
+      elif data.metadata_mediatype == "movie":
           folder_path = os.path.join(
               root_folder
           )
 
-      elif data.get("metadata_mediatype") == "anime":
+      elif data.metadata_mediatype == "anime":
           if not metadata_foldername:
               return None
           folder_path = os.path.join(
@@ -44,24 +48,41 @@ def generateFolderPath(data: dict) -> str | None:
           
       return folder_path
 
-def generateStremFile(file_path: str, url: str, type: str, file_name: str, download=None):
+def generateStremPath(download: FileRecord) -> str | None:
+    """
+    Takes in a user download and returns the path of its strm file relative to the mount path.
+    """
+    file_path = generateFolderPath(download)
+    if file_path is None:
+        return None
     if RAW_MODE:
-        original_path = download.get("path")
-        if original_path:
-            full_path = os.path.join(MOUNT_PATH, os.path.dirname(original_path))
-    else:
-        if type == "movie":
-            type = "movies"
-        elif type == "series":
-            type = "series"
-        elif type == "anime":
-            type = "series"
-        full_path = os.path.join(MOUNT_PATH, type, file_path)
+        return os.path.join(file_path, f"{download.metadata_filename}.strm")
+    type = download.metadata_mediatype
+    if type == "movie":
+        type = "movies"
+    elif type == "series":
+        type = "series"
+    elif type == "anime":
+        type = "series"
+    return os.path.join(type, file_path, f"{download.metadata_filename}.strm")
+
+def generateStremFile(strm_path: str, url: str):
+    """
+    Writes a strm file atomically, so media servers never see a partially written file.
+    Its folder is expected to exist already, and is only created here if it went missing.
+    """
+    full_path = os.path.join(MOUNT_PATH, strm_path)
+    temp_path = f"{full_path}.tmp"
     try:
-        os.makedirs(full_path, exist_ok=True)
-        with open(f"{full_path}/{file_name}.strm", "w") as file:
+        try:
+            file = open(temp_path, "w")
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            file = open(temp_path, "w")
+        with file:
             file.write(url)
-        logging.debug(f"Created strm file: {full_path}/{file_name}.strm")
+        os.replace(temp_path, full_path)
+        logging.debug(f"Created strm file: {full_path}")
         return True
     except FileNotFoundError as e:
         logging.error(f"Error creating strm file (likely bad naming scheme of file): {e}")
@@ -73,45 +94,138 @@ def generateStremFile(file_path: str, url: str, type: str, file_name: str, downl
         logging.error(f"Error creating strm file: {e}")
         return False
 
+def urlHash(url: str):
+    return hashlib.blake2b(url.encode(), digest_size=8).hexdigest()
+
+def loadManifest():
+    """
+    Returns the strm files written by the last run, as paths relative to the mount path mapped to the hash of their url.
+    """
+    try:
+        with open(STRM_MANIFEST_PATH, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.error(f"Error loading strm manifest, rewriting every strm file: {e}")
+        return {}
+
+def saveManifest(manifest: dict):
+    temp_path = f"{STRM_MANIFEST_PATH}.tmp"
+    try:
+        with open(temp_path, "w") as file:
+            json.dump(manifest, file)
+        os.replace(temp_path, STRM_MANIFEST_PATH)
+    except OSError as e:
+        logging.error(f"Error saving strm manifest: {e}")
+
+def removeStremFile(strm_path: str):
+    """
+    Removes a strm file, returning whether it is gone.
+    """
+    try:
+        os.remove(os.path.join(MOUNT_PATH, strm_path))
+        logging.debug(f"Removed stale .strm file: {strm_path}")
+        return True
+    except FileNotFoundError:
+        return True
+    except Exception as e:
+        logging.error(f"Error removing .strm file: {e}")
+        return False
+
+def parentFolders(strm_paths):
+    """
+    Returns every folder holding the given strm paths, relative to the mount path.
+    """
+    folders = set()
+    for strm_path in strm_paths:
+        folder = os.path.dirname(strm_path)
+        while folder and folder not in folders:
+            folders.add(folder)
+            folder = os.path.dirname(folder)
+    return folders
+
+def createFolders(folders):
+    """
+    Creates folders once each, parents first.
+    """
+    for folder in sorted(folders, key=lambda folder: folder.count(os.sep)):
+        try:
+            os.mkdir(os.path.join(MOUNT_PATH, folder))
+        except FileExistsError:
+            pass
+        except OSError as e:
+            logging.error(f"Error creating folder {folder}: {e}")
+
+def pruneFolders(folders, live_folders):
+    """
+    Removes the folders left empty, deepest first. Folders still holding strm files aren't even looked at.
+    """
+    for folder in sorted(folders - live_folders, key=lambda folder: folder.count(os.sep), reverse=True):
+        try:
+            os.rmdir(os.path.join(MOUNT_PATH, folder))
+        except OSError:
+            # holds files other than strm files
+            pass
+
 def runStrm():
-    all_downloads = getAllUserDownloads()
-    # Get all existing .strm files
-    existing_strm_files = set(glob.glob(os.path.join(MOUNT_PATH, "**", "*.strm"), recursive=True))
+    """
+    Brings the strm files up to date with the user downloads.
+
+    The target tree is planned in memory first. Only strm files that are new or whose url changed
+    are written, only files listed in the manifest of the last run are removed, and every folder is
+    created or pruned at most once, so an unchanged library causes no writes or scans. Files are
+    written and removed by STRM_WORKERS threads at once.
+    """
+    all_downloads, success = getAllUserDownloads()
+    if not success:
+        logging.error("Error reading the stored downloads, keeping the strm files as they are.")
+        return
+    manifest = loadManifest()
 
-    new_strm_files = set()
+    new_manifest = {}
+    to_write = {}
     for download in all_downloads:
-        file_path = generateFolderPath(download)
-        if file_path is None:
+        strm_path = generateStremPath(download)
+        if strm_path is None or strm_path in new_manifest:
             continue
-        if RAW_MODE:
-            strm_path = os.path.join(MOUNT_PATH, file_path, f"{download.get('metadata_filename')}.strm")
-        else:
-            type = download.get("metadata_mediatype")
-            if type == "movie":
-                type = "movies"
-            elif type == "series":
-                type = "series"
-            elif type == "anime":
-                type = "series"
-            strm_path = os.path.join(MOUNT_PATH, type, file_path, f"{download.get('metadata_filename')}.strm")
-        new_strm_files.add(strm_path)
-        generateStremFile(file_path, download.get("download_link"), download.get("metadata_mediatype"), download.get("metadata_filename"), download)
-
-    # Remove .strm files for deleted downloads
-    for strm_file in existing_strm_files:
-        if strm_file not in new_strm_files:
-            try:
-                os.remove(strm_file)
-                logging.debug(f"Removed stale .strm file: {strm_file}")
-                # Remove empty directories
-                dir = os.path.dirname(strm_file)
-                while dir != MOUNT_PATH and not os.listdir(dir):
-                    os.rmdir(dir)
-                    dir = os.path.dirname(dir)
-            except Exception as e:
-                logging.error(f"Error removing .strm file: {e}")
-
-    logging.debug(f"Updated {len(all_downloads)} strm files.")
+        url = proxyUrl(download) if STRM_PROXY else download.download_link
+        url_hash = urlHash(url)
+        new_manifest[strm_path] = url_hash
+        if manifest.get(strm_path) != url_hash:
+            to_write[strm_path] = url
+    stale = [strm_path for strm_path in manifest if strm_path not in new_manifest]
+
+    # folders of files from the last run already exist
+    existing_folders = parentFolders(manifest)
+    createFolders(parentFolders(to_write) - existing_folders)
+
+    with ThreadPoolExecutor(max_workers=STRM_WORKERS, thread_name_prefix="strm") as executor:
+        written_results = executor.map(generateStremFile, to_write.keys(), to_write.values())
+        removed_results = executor.map(removeStremFile, stale)
+        written = 0
+        for strm_path, success in zip(to_write, written_results):
+            if success:
+                written += 1
+            elif strm_path in manifest:
+                # the old file is still in place
+                new_manifest[strm_path] = manifest[strm_path]
+            else:
+                del new_manifest[strm_path]
+        removed = 0
+        for strm_path, success in zip(stale, removed_results):
+            if success:
+                removed += 1
+            else:
+                # keep it listed so removing it is retried on the next run
+                new_manifest[strm_path] = manifest[strm_path]
+
+    if removed:
+        pruneFolders(parentFolders(stale), parentFolders(new_manifest))
+
+    if written or removed or new_manifest != manifest:
+        saveManifest(new_manifest)
+    logging.debug(f"Updated strm files: {written} written, {removed} removed, {len(new_manifest) - written} unchanged.")
 
 def unmountStrm():
     """
@@ -0,0 +1,158 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import quote
+from library.filesystem import STRM_PROXY, STRM_PROXY_HOST, STRM_PROXY_PORT, STRM_PROXY_URL
+from library.http import USER_AGENT
+from library.torbox import TORBOX_API_KEY
+from functions.torboxFunctions import getDownloadLink
+from functions.recordFunctions import FileRecord, IDType
+from functions.cacheFunctions import SingleFlight
+import threading
+import hashlib
+import hmac
+import logging
+import httpx
+import time
+
+LINK_AGE = 3 * 60 * 60 # 3 hours
+FORWARDED_REQUEST_HEADERS = ("Range", "If-Range")
+FORWARDED_RESPONSE_HEADERS = ("Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "Last-Modified", "ETag")
+EXPIRED_STATUS_CODES = (401, 403, 404, 410) # what the CDN answers for a link that is no longer valid
+# part of every url, so files can't be streamed by guessing their ids. Derived from the API key so the strm files stay valid across restarts
+PROXY_TOKEN = hashlib.blake2b(TORBOX_API_KEY.encode(), digest_size=16, person=b"strm-proxy").hexdigest()
+
+# shared by every request, so connections to the CDN are reused between reads and seeks
+stream_client = httpx.Client(
+    headers={
+        "User-Agent": USER_AGENT,
+        # the body is forwarded as is, and byte ranges of a compressed body are useless to a player
+        "Accept-Encoding": "identity",
+    },
+    timeout=httpx.Timeout(60),
+    follow_redirects=True,
+    limits=httpx.Limits(max_connections=None, max_keepalive_connections=32),
+)
+
+cached_links = {}
+links_lock = threading.Lock()
+link_requests = SingleFlight()
+
+def proxyUrl(download: FileRecord):
+    """
+    Returns the url of a download on the proxy. It only identifies the file and holds the proxy token, not the API key.
+    """
+    return f"{STRM_PROXY_URL}/{PROXY_TOKEN}/{download.type}/{download.item_id}/{download.file_id}/{quote(download.file_name or '')}"
+
+def getProxiedLink(type: str, item_id: int, file_id: int, refresh: bool = False):
+    """
+    Returns the CDN link of a file, resolving it only if it isn't cached, is too old or has to be refreshed.
+    Concurrent requests for the same file share a single resolution.
+    """
+    key = (type, item_id, file_id)
+    if not refresh:
+        with links_lock:
+            cached_link = cached_links.get(key)
+        if cached_link and time.time() - cached_link["timestamp"] <= LINK_AGE:
+            return cached_link["link"]
+    return link_requests.do([key], resolveLink, key, refresh)
+
+def resolveLink(key: tuple, refresh: bool):
+    type, item_id, file_id = key
+    download_link = getDownloadLink(FileRecord(type=type, item_id=item_id, file_id=file_id).download_link, use_cache=not refresh)
+    now = time.time()
+    with links_lock:
+        for expired_key in [cached_key for cached_key, cached_link in cached_links.items() if now - cached_link["timestamp"] > LINK_AGE]:
+            del cached_links[expired_key]
+        cached_links[key] = {
+            "link": download_link,
+            "timestamp": now,
+        }
+    return download_link
+
+class StrmProxyHandler(BaseHTTPRequestHandler):
+    """
+    Streams files to media servers, forwarding range requests to the resolved CDN link of the file.
+    """
+    protocol_version = "HTTP/1.1" # keeps connections from players open between reads
+
+    def do_GET(self):
+        self.proxy(send_body=True)
+
+    def do_HEAD(self):
+        self.proxy(send_body=False)
+
+    def log_message(self, format, *args):
+        logging.debug(f"STRM proxy: {self.address_string()} {format % args}")
+
+    def parseFile(self):
+        parts = self.path.split("?", 1)[0].strip("/").split("/")
+        if len(parts) < 4 or not hmac.compare_digest(parts[0], PROXY_TOKEN):
+            return None
+        type, item_id, file_id = parts[1:4]
+        if type not in IDType.__members__ or not item_id.isdigit() or not file_id.isdigit():
+            return None
+        return type, int(item_id), int(file_id)
+
+    def proxy(self, send_body: bool):
+        file = self.parseFile()
+        if file is None:
+            self.send_error(404)
+            return
+        headers = {name: self.headers[name] for name in FORWARDED_REQUEST_HEADERS if self.headers.get(name)}
+        responded = False
+
+        for attempt in range(2):
+            try:
+                link = getProxiedLink(*file, refresh=attempt > 0)
+            except Exception as e:
+                logging.error(f"Error resolving link for {self.path}: {e}")
+                self.send_error(502)
+                return
+            try:
+                # HEAD requests are sent as GET too, since signed links often only allow GET
+                with stream_client.stream("GET", link, headers=headers) as response:
+                    if response.status_code in EXPIRED_STATUS_CODES and attempt == 0:
+                        logging.debug(f"Link for {self.path} expired, refreshing...")
+                        continue
+                    self.send_response(response.status_code)
+                    for name in FORWARDED_RESPONSE_HEADERS:
+                        if name in response.headers:
+                            self.send_header(name, response.headers[name])
+                    if "Content-Length" not in response.headers:
+                        # without a length the end of the body can only be told by closing the connection
+                        self.close_connection = True
+                    self.end_headers()
+                    responded = True
+                    if send_body:
+                        for data in response.iter_raw():
+                            self.wfile.write(data)
+                    return
+            except (BrokenPipeError, ConnectionResetError):
+                # the player stopped reading, usually to seek
+                self.close_connection = True
+                return
+            except httpx.RequestError as e:
+                logging.error(f"Error streaming {self.path}: {e}")
+                if responded:
+                    self.close_connection = True
+                else:
+                    self.send_error(502)
+                return
+
+def startStrmProxy():
+    """
+    Starts the proxy in the background if it is enabled, returning the server.
+    """
+    if not STRM_PROXY:
+        return None
+    server = ThreadingHTTPServer((STRM_PROXY_HOST, STRM_PROXY_PORT), StrmProxyHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"STRM proxy listening on {STRM_PROXY_HOST}:{STRM_PROXY_PORT}, strm files point at {STRM_PROXY_URL}")
+    return server
+
+def stopStrmProxy(server):
+    if server is None:
+        return
+    server.shutdown()
+    server.server_close()
+    stream_client.close()
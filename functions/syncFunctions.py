@@ -0,0 +1,137 @@
+from functions.torboxFunctions import getUserItemPages, processItems, isAcceptedFile, DownloadType, MetadataLookups
+from functions.databaseFunctions import getAllData, deleteData, BatchWriter, beginGeneration, publishGeneration
+from library.app import SCAN_METADATA, INGEST_PAGE_SIZE, INGEST_WINDOW, METADATA_NEGATIVE_CACHE_TTL
+import logging
+import asyncio
+import time
+import httpx
+
+def itemSignature(item: dict):
+    """
+    Returns what identifies the processed state of an item from the API.
+    Items only named by their hash get no name, since they are named after their parsed title instead.
+    """
+    file_ids = frozenset(file.get("id") for file in item.get("files", []) if isAcceptedFile(file))
+    name = None if item.get("name") == item.get("hash") else item.get("name")
+    return item.get("hash"), name, file_ids, SCAN_METADATA
+
+def recordsSignatures(records: list):
+    """
+    Returns what identifies the processed state of every item from its stored records, by item id,
+    along with when the metadata of an item that couldn't be resolved should be searched for again.
+    """
+    file_ids = {}
+    first_records = {}
+    retry_times = {}
+    for record in records:
+        file_ids.setdefault(record.item_id, set()).add(record.file_id)
+        first_records.setdefault(record.item_id, record)
+        if record.metadata_scanned and not record.metadata_resolved:
+            # records from before lookups were tracked are searched for again right away
+            retry_time = (record.metadata_searched_at or 0) + METADATA_NEGATIVE_CACHE_TTL
+            retry_times[record.item_id] = min(retry_times.get(record.item_id, retry_time), retry_time)
+    return {
+        item_id: (record.folder_hash, record.folder_name, frozenset(file_ids[item_id]), record.metadata_scanned, retry_times.get(item_id))
+        for item_id, record in first_records.items()
+    }
+
+def isUnchanged(signature: tuple, item: dict, now: float):
+    """
+    Returns whether an item can keep its stored records: its hash, name and files are the same, it was processed
+    with the same metadata setting and, if its metadata couldn't be resolved, it isn't time to search for it again.
+    """
+    hash, name, file_ids, metadata_scanned, retry_time = signature
+    item_hash, item_name, item_file_ids, item_metadata_scanned = itemSignature(item)
+    if (hash, file_ids, metadata_scanned) != (item_hash, item_file_ids, item_metadata_scanned):
+        return False
+    if item_name is not None and name != item_name:
+        return False
+    return retry_time is None or retry_time > now
+
+async def syncUserDownloads(type: DownloadType, api_client: httpx.AsyncClient, lookups: MetadataLookups):
+    """
+    Brings the database of a download type up to date with the API, returning how many files it holds.
+
+    Items whose hash, name and files are unchanged keep their stored records, new or changed
+    items, and items whose metadata lookup failed longer than METADATA_NEGATIVE_CACHE_TTL ago,
+    are processed, and records of items that are gone are deleted, so a refresh only costs as
+    much as what changed since the last one. Each page of items is processed while the next
+    ones are being fetched, with at most INGEST_WINDOW items fetched but not yet processed,
+    and items are let go of as soon as they are processed. Only the signatures of the stored
+    items are kept during the refresh, not their records.
+
+    Changes are made to a new generation of the database, which is only published once the
+    whole refresh succeeded, so readers never see a partially refreshed library.
+    """
+    generation, success, detail = await asyncio.to_thread(beginGeneration, type.value)
+    if not success:
+        return None, False, detail
+
+    existing, success, detail = await asyncio.to_thread(getAllData, type.value)
+    if not success:
+        return None, False, detail
+
+    existing_signatures = recordsSignatures(existing)
+    del existing
+    now = time.time()
+
+    # a page takes a slot of the window from before it is fetched until it is processed
+    pages = asyncio.Queue()
+    window = asyncio.Semaphore(INGEST_WINDOW // INGEST_PAGE_SIZE)
+    fetcher = asyncio.create_task(getUserItemPages(api_client, type, pages, window))
+
+    file_count = 0
+    unchanged_count = 0
+    changed_count = 0
+    seen_item_ids = set()
+    page = []
+    try:
+        async with BatchWriter(type.value, generation=generation) as writer:
+            while (page := await pages.get()) is not None:
+                try:
+                    changed_items = []
+                    for item in page:
+                        if not item.get("cached", False) or item.get("id") in seen_item_ids:
+                            continue
+                        seen_item_ids.add(item.get("id"))
+                        signature = existing_signatures.get(item.get("id"))
+                        if signature is not None and isUnchanged(signature, item, now):
+                            unchanged_count += len(signature[2])
+                        else:
+                            changed_items.append(item)
+                    page.clear()
+                    if not changed_items:
+                        continue
+
+                    outdated_item_ids = [item.get("id") for item in changed_items if item.get("id") in existing_signatures]
+                    if outdated_item_ids:
+                        success, detail = await asyncio.to_thread(deleteData, outdated_item_ids, type.value, generation)
+                        if not success:
+                            return None, False, detail
+                    changed_count += len(changed_items)
+                    file_count += len(await processItems(changed_items, type, lookups, writer))
+                finally:
+                    window.release()
+    finally:
+        # only stop fetching if processing ended before the last page
+        if page is not None:
+            fetcher.cancel()
+
+    success, detail = await fetcher
+    if not success:
+        return None, False, detail
+    if writer.failed:
+        return None, False, f"Failed to write {writer.failed} {type.value} records."
+
+    stale_item_ids = [item_id for item_id in existing_signatures if item_id not in seen_item_ids]
+    if stale_item_ids:
+        success, detail = await asyncio.to_thread(deleteData, stale_item_ids, type.value, generation)
+        if not success:
+            return None, False, detail
+
+    success, detail = await asyncio.to_thread(publishGeneration, type.value, generation)
+    if not success:
+        return None, False, detail
+
+    logging.info(f"Synced {type.value}: {unchanged_count} unchanged files, {changed_count} new or changed items, {len(stale_item_ids)} removed items.")
+    return unchanged_count + file_count, True, f"{type.value.capitalize()} synced successfully."
@@ -1,138 +1,254 @@
-from library.http import api_http_client, search_api_http_client, general_http_client, requestWrapper
+from library.http import general_http_client, requestWrapper, asyncRequestWrapper
 import httpx
 from enum import Enum
-import PTN
-from library.torbox import TORBOX_API_KEY
-from library.app import SCAN_METADATA
-from functions.mediaFunctions import constructSeriesTitle, cleanTitle, cleanYear
-from functions.databaseFunctions import insertData
+from library.app import SCAN_METADATA, METADATA_CACHE_TTL, METADATA_NEGATIVE_CACHE_TTL, INGEST_CONCURRENCY, INGEST_PAGE_SIZE
+from functions.mediaFunctions import constructSeriesTitle, cleanTitle, cleanYear, normalizeTitle
+from functions.databaseFunctions import BatchWriter, getValue, setValue
+from functions.recordFunctions import FileRecord
+from functions.parseFunctions import parseTitles
 import os
+import time
 import logging
 import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import multiprocessing
+import asyncio
 
 class DownloadType(Enum):
     torrent = "torrents"
     usenet = "usenet"
     webdl = "webdl"
 
-class IDType(Enum):
-    torrents = "torrent_id"
-    usenet = "usenet_id"
-    webdl = "web_id"
-
 ACCEPTABLE_MIME_TYPES = [
     "video/x-matroska",
     "video/mp4",
 ]
 
-def process_file(item, file, type):
-    """Process a single file and return the processed data"""
-    if not file.get("mimetype").startswith("video/") or file.get("mimetype") not in ACCEPTABLE_MIME_TYPES:
+METADATA_CACHE_NAME = "metadata_cache"
+METADATA_FIELDS = ["title", "releaseYears", "type", "link", "image", "backdrop"]
+
+def isAcceptedFile(file):
+    """Returns whether a file is a video file that should be mounted"""
+    return file.get("mimetype", "").startswith("video/") and file.get("mimetype") in ACCEPTABLE_MIME_TYPES
+
+def process_file(item, file, type, title_data: dict, lookup: tuple | None):
+    """Process a single file and return the processed data, using its parsed title and the metadata lookup of its group"""
+    if not isAcceptedFile(file):
         logging.debug(f"Skipping file {file.get('short_name')} with mimetype {file.get('mimetype')}")
         return None
-    
-    data = {
-        "item_id": item.get("id"),
-        "type": type.value,
-        "folder_name": item.get("name"),
-        "DEBUG_name": item.get("name"),
-        "DEBUG_hash": item.get("hash"),
-        "DEBUG_file_name": file.get("short_name"),
-        "folder_hash": item.get("hash"),
-        "file_id": file.get("id"),
-        "file_name": file.get("short_name"),
-        "file_size": file.get("size"),
-        "file_mimetype": file.get("mimetype"),
-        "path": file.get("name"),
-        "download_link": f"https://api.torbox.app/v1/api/{type.value}/requestdl?token={TORBOX_API_KEY}&{IDType[type.value].value}={item.get('id')}&file_id={file.get('id')}&redirect=true",
-        "extension": os.path.splitext(file.get("short_name"))[-1],              
-    }
-    title_data = PTN.parse(file.get("short_name"))
 
+    metadata, resolved, _ = searchMetadata(title_data.get("title", file.get("short_name")), title_data, file.get("short_name"), item.get("hash"), item.get("name"), lookup)
+    data = FileRecord(
+        item_id=item.get("id"),
+        type=type.value,
+        folder_name=item.get("name"),
+        folder_hash=item.get("hash"),
+        file_id=file.get("id"),
+        file_name=file.get("short_name"),
+        file_size=file.get("size"),
+        file_mimetype=file.get("mimetype"),
+        path=file.get("name"),
+        created_at=item.get("created_at"),
+        metadata_scanned=SCAN_METADATA,
+        # unresolved lookups are retried by a later refresh, once their negative cache entry expired
+        metadata_resolved=resolved if SCAN_METADATA else None,
+        metadata_searched_at=int(time.time()) if SCAN_METADATA else None,
+        **metadata,
+    )
+    logging.debug(data)
+    return data
+
+def parseFile(item, file, title_data: dict):
+    """Names the item of a file after its parsed title if the item is only named by its hash"""
     if item.get("name") == item.get("hash"):
         item["name"] = title_data.get("title", file.get("short_name"))
 
-    metadata, _, _ = searchMetadata(title_data.get("title", file.get("short_name")), title_data, file.get("short_name"), f"{item.get('name')} {file.get('short_name')}", item.get("hash"), item.get("name"))
-    data.update(metadata)
-    logging.debug(data)
-    insertData(data, type.value)
-    return data
+    return title_data
 
-def getUserDownloads(type: DownloadType):
-    offset = 0
-    limit = 1000
+async def process_group(members: list, type: DownloadType, lookups: "MetadataLookups"):
+    """Looks up the metadata shared by a group of files once and processes every file of the group with it"""
+    lookup = None
+    if SCAN_METADATA:
+        item, file, title_data = members[0]
+        cache_key = metadataCacheKey(title_data.get("title", file.get("short_name")), title_data, item.get("name"))
+        lookup = await lookups.get(f"{item.get('name')} {file.get('short_name')}", cache_key)
 
-    file_data = []
-    
-    while True:
-        params = {
-            "limit": limit,
-            "offset": offset,
-            "bypass_cache": True,
-        }
+    results = []
+    for item, file, title_data in members:
         try:
-            response = api_http_client.get(f"/{type.value}/mylist", params=params)
+            results.append(process_file(item, file, type, title_data, lookup))
         except Exception as e:
-            logging.error(f"Error fetching {type.value} at offset {offset}: {e}")
-            return None, False, f"Error fetching {type.value} at offset {offset}: {e}"
-        if response.status_code != 200:
-            return None, False, f"Error fetching {type.value} at offset {offset}. {response.status_code}"
-        try:
-            data = response.json().get("data", [])
-        except Exception as e:
-            logging.error(f"Error parsing {type.value} at offset {offset}: {e}")
-            logging.error(f"Response: {response.text}")
-            return None, False, f"Error parsing {type.value} at offset {offset}. {e}"
-        if not data:
-            break
-        file_data.extend(data)
-        offset += limit
-        if len(data) < limit:
-            break
-
-    if not file_data:
-        return None, True, f"No {type.value} found."
-    
-    logging.debug(f"Fetched {len(file_data)} {type.value} items from API.")
-    
+            logging.error(f"Error processing file {file.get('short_name', 'unknown')}: {e}")
+            logging.error(traceback.format_exc())
+    return results
+
+async def getUserItemsPage(client: httpx.AsyncClient, type: DownloadType, offset: int, limit: int):
+    """Fetches a single page of items of a download type from the API"""
+    params = {
+        "limit": limit,
+        "offset": offset,
+        "bypass_cache": True,
+    }
+    try:
+        response = await client.get(f"/{type.value}/mylist", params=params)
+    except Exception as e:
+        logging.error(f"Error fetching {type.value} at offset {offset}: {e}")
+        return None, False, f"Error fetching {type.value} at offset {offset}: {e}"
+    if response.status_code != 200:
+        return None, False, f"Error fetching {type.value} at offset {offset}. {response.status_code}"
+    try:
+        data = response.json().get("data", [])
+    except Exception as e:
+        logging.error(f"Error parsing {type.value} at offset {offset}: {e}")
+        logging.error(f"Response: {response.text}")
+        return None, False, f"Error parsing {type.value} at offset {offset}. {e}"
+    return data, True, f"{type.value.capitalize()} items fetched successfully."
+
+async def getUserItemPages(client: httpx.AsyncClient, type: DownloadType, pages: asyncio.Queue, window: asyncio.Semaphore):
+    """
+    Fetches every item of a download type from the API page by page, putting each page on the queue as soon as it arrives.
+    Every page takes a slot of the window before it is fetched, which the consumer releases once it is done with the page.
+    The queue is ended with None, whether or not every page could be fetched.
+    """
+    offset = 0
+    limit = INGEST_PAGE_SIZE
+    item_count = 0
+
+    try:
+        while True:
+            await window.acquire()
+            data, success, detail = await getUserItemsPage(client, type, offset, limit)
+            if not success or not data:
+                window.release()
+                if not success:
+                    return False, detail
+                break
+            await pages.put(data)
+            item_count += len(data)
+            offset += limit
+            if len(data) < limit:
+                break
+    finally:
+        await pages.put(None)
+
+    logging.debug(f"Fetched {item_count} {type.value} items from API.")
+    return True, f"{type.value.capitalize()} items fetched successfully."
+
+async def processItems(file_data: list, type: DownloadType, lookups: "MetadataLookups", writer: BatchWriter):
+    """
+    Processes the files of the given items concurrently on the event loop, hands them to the writer and returns the processed data.
+    """
     files = []
     
-    # Get the number of CPU cores for parallel processing
-    max_workers = int(multiprocessing.cpu_count() * 2 - 1)
-    logging.info(f"Processing files with {max_workers} parallel threads")
-    
-    # Collect all files to process
-    files_to_process = []
-    for item in file_data:
-        if not item.get("cached", False):
-            continue
-        for file in item.get("files", []):
-            files_to_process.append((item, file))
+    # Group the files by the metadata they will share, e.g. all episodes of a season pack,
+    # so each distinct title is only searched once
+    accepted = [(item, file) for item in file_data if item.get("cached", False) for file in item.get("files", []) if isAcceptedFile(file)]
+    titles = await parseTitles([file.get("short_name") for _, file in accepted])
+    groups = {}
+    for item, file in accepted:
+        title_data = parseFile(item, file, titles[file.get("short_name")])
+        cache_key = metadataCacheKey(title_data.get("title", file.get("short_name")), title_data, item.get("name"))
+        groups.setdefault(cache_key, []).append((item, file, title_data))
+    logging.debug(f"Processing {len(accepted)} {type.value} files in {len(groups)} title groups")
+
+    async def processSafely(cache_key: str):
+        try:
+            return await process_group(groups.pop(cache_key), type, lookups)
+        except Exception as e:
+            logging.error(f"Error processing files of {cache_key}: {e}")
+            logging.error(traceback.format_exc())
+            return []
     
-    # Process files in parallel
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all tasks
-        future_to_file = {
-            executor.submit(process_file, item, file, type): (item, file) 
-            for item, file in files_to_process
-        }
-        
-        # Collect results as they complete
-        for future in as_completed(future_to_file):
-            try:
-                data = future.result()
-                if data:
-                    files.append(data)
-            except Exception as e:
-                item, file = future_to_file[future]
-                logging.error(f"Error processing file {file.get('short_name', 'unknown')}: {e}")
-                logging.error(traceback.format_exc())
+    for task in asyncio.as_completed([processSafely(cache_key) for cache_key in list(groups)]):
+        for data in await task:
+            if data:
+                files.append(data)
+                writer.add(data)
             
-    return files, True, f"{type.value.capitalize()} fetched successfully."
+    return files
 
-def searchMetadata(query: str, title_data: dict, file_name: str, full_title: str, hash: str, item_name: str):
+def metadataCacheKey(query: str, title_data: dict, item_name: str):
+    """
+    Returns the key a metadata search is cached under, made of the normalised title, year and season.
+    Titles without a year are also keyed by their item, so different releases sharing a title don't collide.
+    """
+    season = title_data.get("season")
+    if isinstance(season, list):
+        season = season[0] if season else None
+    year = title_data.get("year")
+    key = f"{normalizeTitle(query)}|{year or ''}|{season or ''}"
+    if not year:
+        key = f"{key}|{normalizeTitle(item_name or '')}"
+    return key
+
+def cachedMetadata(cache_key: str):
+    """
+    Returns the cached lookup of a metadata search, or None if it isn't cached.
+    """
+    cached = getValue(cache_key, METADATA_CACHE_NAME)
+    if cached is None:
+        return None
+    logging.debug(f"Metadata cache hit for {cache_key}")
+    return cached.get("data"), True, "Metadata retrieved from cache."
+
+def storeMetadata(cache_key: str, response: httpx.Response):
+    """
+    Turns a metadata search response into a lookup and caches it.
+    Both found and not found results are cached, failed searches are not.
+    """
+    if response.status_code != 200:
+        logging.error(f"Error searching metadata: {response.status_code}. {response.text}")
+        return None, False, f"Error searching metadata. {response.status_code}."
+    try:
+        results = response.json().get("data", [])
+    except Exception as e:
+        logging.error(f"Error parsing metadata: {e}")
+        return None, False, f"Error parsing metadata: {e}."
+
+    data = {field: results[0].get(field) for field in METADATA_FIELDS} if results else None
+    ttl = METADATA_CACHE_TTL if data else METADATA_NEGATIVE_CACHE_TTL
+    success, detail = setValue(cache_key, {"data": data}, ttl, METADATA_CACHE_NAME)
+    if not success:
+        logging.error(f"Error caching metadata: {detail}")
+    return data, True, "Metadata searched successfully."
+
+async def lookupMetadataAsync(client: httpx.AsyncClient, full_title: str, cache_key: str):
+    """
+    Returns the first metadata search result for a title, using the persistent cache when possible.
+    The cache is read and written off the event loop.
+    """
+    cached = await asyncio.to_thread(cachedMetadata, cache_key)
+    if cached is not None:
+        return cached
+    try:
+        response = await asyncRequestWrapper(client, "GET", f"/meta/search/{full_title}", use_cache=False, params={"type": "file"})
+    except httpx.TimeoutException:
+        return None, False, "Timeout searching metadata."
+    except Exception as e:
+        logging.error(f"Error searching metadata: {e}")
+        return None, False, f"Error searching metadata: {e}."
+    return await asyncio.to_thread(storeMetadata, cache_key, response)
+
+class MetadataLookups:
+    """
+    Shares metadata lookups between every file group of a refresh, so a title is only searched once
+    even when it shows up on several pages or download types, with at most `concurrency` searches in flight.
+    """
+    def __init__(self, client: httpx.AsyncClient, concurrency: int = INGEST_CONCURRENCY):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.lookups = {}
+
+    async def get(self, full_title: str, cache_key: str):
+        lookup = self.lookups.get(cache_key)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._lookup(full_title, cache_key))
+            self.lookups[cache_key] = lookup
+        return await asyncio.shield(lookup)
+
+    async def _lookup(self, full_title: str, cache_key: str):
+        async with self.semaphore:
+            return await lookupMetadataAsync(self.client, full_title, cache_key)
+
+def searchMetadata(query: str, title_data: dict, file_name: str, hash: str, item_name: str, lookup: tuple | None):
     base_metadata = {
         "metadata_title": cleanTitle(query),
         "metadata_link": None,
@@ -149,17 +265,12 @@ def searchMetadata(query: str, title_data: dict, file_name: str, full_title: str
         base_metadata["metadata_rootfoldername"] = item_name
         return base_metadata, False, "Metadata scanning is disabled."
     extension = os.path.splitext(file_name)[-1]
+    data, success, detail = lookup
+    if not success:
+        return base_metadata, False, f"{detail} Searching for {query}, item hash: {hash}"
+    if not data:
+        return base_metadata, False, f"No metadata found. Searching for {query}, item hash: {hash}"
     try:
-        response = requestWrapper(search_api_http_client, "GET", f"/meta/search/{full_title}", params={"type": "file"})
-    except Exception as e:
-        logging.error(f"Error searching metadata: {e}")
-        return base_metadata, False, f"Error searching metadata: {e}. Searching for {query}, item hash: {hash}"
-    if response.status_code != 200:
-        logging.error(f"Error searching metadata: {response.status_code}. {response.text}")
-        return base_metadata, False, f"Error searching metadata. {response.status_code}. Searching for {query}, item hash: {hash}"
-    try:
-        data = response.json().get("data", [])[0]
-
         title = cleanTitle(data.get("title"))
         base_metadata["metadata_title"] = title
         base_metadata["metadata_years"] = cleanYear(title_data.get("year", None) or data.get("releaseYears", None))
@@ -183,32 +294,63 @@ def searchMetadata(query: str, title_data: dict, file_name: str, full_title: str
         base_metadata["metadata_rootfoldername"] = f"{title} ({base_metadata['metadata_years']})"
 
         return base_metadata, True, f"Metadata found. Searching for {query}, item hash: {hash}"
-    except IndexError:
-        return base_metadata, False, f"No metadata found. Searching for {query}, item hash: {hash}"
-    except httpx.TimeoutException:
-        return base_metadata, False, f"Timeout searching metadata. Searching for {query}, item hash: {hash}"
     except Exception as e:
         logging.error(f"Error searching metadata: {e}")
         logging.error(f"Error searching metadata: {traceback.format_exc()}")
         return base_metadata, False, f"Error searching metadata: {e}. Searching for {query}, item hash: {hash}"
 
-def getDownloadLink(url: str):
-    response = requestWrapper(general_http_client, "GET", url)
+def getDownloadLink(url: str, use_cache: bool = True):
+    response = requestWrapper(general_http_client, "GET", url, use_cache=use_cache)
     if response.status_code == httpx.codes.TEMPORARY_REDIRECT or response.status_code == httpx.codes.PERMANENT_REDIRECT or response.status_code == httpx.codes.FOUND:
         return response.headers.get('Location')
     return url
 
-def downloadFile(url: str, size: int, offset: int = 0):
-    headers = {
-        "Range": f"bytes={offset}-{offset + size - 1}",
-        **general_http_client.headers,
-    }
-    response = requestWrapper(general_http_client, "GET", url, headers=headers)
-    if response.status_code == httpx.codes.OK:
-        return response.content
-    elif response.status_code == httpx.codes.PARTIAL_CONTENT:
-        return response.content
-    else:
-        logging.error(f"Error downloading file: {response.status_code}")
-        raise Exception(f"Error downloading file: {response.status_code}")
-    
+def downloadFile(url: str, size: int, offset: int = 0, chunk_size: int | None = None):
+    """
+    Downloads a byte range of a file, streaming the body straight into preallocated buffers of chunk_size bytes.
+
+    Returns a list of memoryviews of the downloaded chunks, each backed by its own buffer so keeping one chunk
+    doesn't keep the whole range in memory. Interrupted or short transfers are resumed from the last received byte.
+    """
+    max_retries = 5
+    backoff_factor = 1.5
+
+    chunk_size = chunk_size or max(size, 1)
+    views = [memoryview(bytearray(min(chunk_size, size - start))) for start in range(0, size, chunk_size)]
+    received = 0
+
+    for attempt in range(max_retries):
+        headers = {
+            "Range": f"bytes={offset + received}-{offset + size - 1}",
+        }
+        try:
+            with general_http_client.stream("GET", url, headers=headers) as response:
+                if response.status_code == httpx.codes.OK and offset + received > 0:
+                    # the server ignored the range, so the body doesn't start at the requested offset
+                    logging.error("Error downloading file: range request not supported")
+                    raise Exception("Error downloading file: range request not supported")
+                if response.status_code != httpx.codes.OK and response.status_code != httpx.codes.PARTIAL_CONTENT:
+                    logging.error(f"Error downloading file: {response.status_code}")
+                    raise Exception(f"Error downloading file: {response.status_code}")
+                for data in response.iter_bytes():
+                    data = memoryview(data)[:size - received]
+                    while data:
+                        # the data can span the end of a chunk, so it is copied a chunk at a time
+                        view = views[received // chunk_size]
+                        position = received % chunk_size
+                        length = min(len(data), len(view) - position)
+                        view[position:position + length] = data[:length]
+                        data = data[length:]
+                        received += length
+                    if received >= size:
+                        break
+            if received < size:
+                # the body ended early without an error, what is missing is requested again
+                raise httpx.RemoteProtocolError(f"Response ended after {received} of {size} bytes")
+            full_chunks, remainder = divmod(received, chunk_size)
+            return views[:full_chunks] + ([views[full_chunks][:remainder]] if remainder else [])
+        except httpx.RequestError as e:
+            wait_time = backoff_factor * (2 ** attempt)
+            logging.warning(f"Request error downloading file at {offset + received}: {e}. Retrying in {wait_time:.2f} seconds...")
+            time.sleep(wait_time)
+    raise httpx.RequestError(f"Failed to download file after {max_retries} attempts.")
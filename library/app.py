@@ -35,3 +35,39 @@ if MOUNT_REFRESH_TIME == "instant" and SCAN_METADATA:
     MOUNT_REFRESH_TIME = MountRefreshTimes.fast.value
 else:
     MOUNT_REFRESH_TIME = MountRefreshTimes[MOUNT_REFRESH_TIME].value
+
+class DatabaseBackends(Enum):
+    sqlite = "sqlite"
+    tinydb = "tinydb"
+
+DATABASE_BACKEND = os.getenv("DATABASE_BACKEND", DatabaseBackends.sqlite.value).lower()
+assert DATABASE_BACKEND in [e.value for e in DatabaseBackends], f"Invalid database backend: {DATABASE_BACKEND}. Valid options are: {[e.value for e in DatabaseBackends]}"
+
+DATABASE_PATH = os.getenv("DATABASE_PATH", "torbox.db")
+
+DATABASE_BATCH_SIZE = int(os.getenv("DATABASE_BATCH_SIZE", 500))
+assert DATABASE_BATCH_SIZE > 0, "DATABASE_BATCH_SIZE must be greater than 0"
+
+DATABASE_BATCH_INTERVAL = float(os.getenv("DATABASE_BATCH_INTERVAL", 2)) # in seconds
+assert DATABASE_BATCH_INTERVAL > 0, "DATABASE_BATCH_INTERVAL must be greater than 0"
+
+METADATA_CACHE_TTL = float(os.getenv("METADATA_CACHE_TTL", 30)) * 24 * 60 * 60 # days to seconds
+METADATA_NEGATIVE_CACHE_TTL = float(os.getenv("METADATA_NEGATIVE_CACHE_TTL", 24)) * 60 * 60 # hours to seconds
+
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", 8))
+assert INGEST_CONCURRENCY > 0, "INGEST_CONCURRENCY must be greater than 0"
+
+API_RATE_LIMIT = float(os.getenv("API_RATE_LIMIT", 5)) # in requests per second, per TorBox API
+assert API_RATE_LIMIT > 0, "API_RATE_LIMIT must be greater than 0"
+API_MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY", 16))
+assert API_MAX_CONCURRENCY > 0, "API_MAX_CONCURRENCY must be greater than 0"
+
+INGEST_PAGE_SIZE = int(os.getenv("INGEST_PAGE_SIZE", 1000)) # items per /mylist request
+assert INGEST_PAGE_SIZE > 0, "INGEST_PAGE_SIZE must be greater than 0"
+INGEST_WINDOW = int(os.getenv("INGEST_WINDOW", 2000)) # items fetched but not yet processed, per download type
+assert INGEST_WINDOW >= INGEST_PAGE_SIZE, "INGEST_WINDOW must be greater than or equal to INGEST_PAGE_SIZE"
+
+WARM_START = os.getenv("WARM_START", "true").lower() == "true"
+
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", os.cpu_count() or 1)) # processes file names are parsed in, 0 parses them in the application itself
+assert PARSE_WORKERS >= 0, "PARSE_WORKERS must be greater than or equal to 0"
@@ -12,4 +12,36 @@ MOUNT_METHOD = os.getenv("MOUNT_METHOD", MountMethods.strm.value)
 assert MOUNT_METHOD in [method.value for method in MountMethods], "MOUNT_METHOD is not set correctly in .env file"
 
 MOUNT_PATH = os.getenv("MOUNT_PATH", "./torbox")
-assert MOUNT_PATH, "MOUNT_PATH is not set in .env file"
\ No newline at end of file
+assert MOUNT_PATH, "MOUNT_PATH is not set in .env file"
+
+STRM_MANIFEST_PATH = os.path.join(MOUNT_PATH, ".strm_manifest.json") # lives in the mount path so it is wiped along with the strm files
+
+FUSE_CACHE_SIZE = int(os.getenv("FUSE_CACHE_SIZE", 4096)) # in MB
+assert FUSE_CACHE_SIZE > 0, "FUSE_CACHE_SIZE must be greater than 0"
+
+FUSE_READAHEAD_BLOCKS = int(os.getenv("FUSE_READAHEAD_BLOCKS", 4))
+assert FUSE_READAHEAD_BLOCKS >= 0, "FUSE_READAHEAD_BLOCKS must be 0 or greater"
+
+FUSE_READAHEAD_WORKERS = int(os.getenv("FUSE_READAHEAD_WORKERS", 4))
+assert FUSE_READAHEAD_WORKERS > 0, "FUSE_READAHEAD_WORKERS must be greater than 0"
+
+FUSE_DISK_CACHE_PATH = os.getenv("FUSE_DISK_CACHE_PATH", "")
+
+FUSE_DISK_CACHE_SIZE = int(os.getenv("FUSE_DISK_CACHE_SIZE", 10240)) # in MB
+assert FUSE_DISK_CACHE_SIZE > 0, "FUSE_DISK_CACHE_SIZE must be greater than 0"
+
+FUSE_MULTITHREADED = os.getenv("FUSE_MULTITHREADED", "true").lower() == "true"
+
+FUSE_ATTR_TIMEOUT = int(os.getenv("FUSE_ATTR_TIMEOUT", 300)) # in seconds
+assert FUSE_ATTR_TIMEOUT >= 0, "FUSE_ATTR_TIMEOUT must be 0 or greater"
+
+FUSE_KERNEL_CACHE = os.getenv("FUSE_KERNEL_CACHE", "true").lower() == "true"
+
+STRM_WORKERS = int(os.getenv("STRM_WORKERS", 8))
+assert STRM_WORKERS > 0, "STRM_WORKERS must be greater than 0"
+
+STRM_PROXY = os.getenv("STRM_PROXY", "false").lower() == "true"
+STRM_PROXY_HOST = os.getenv("STRM_PROXY_HOST", "127.0.0.1")
+STRM_PROXY_PORT = int(os.getenv("STRM_PROXY_PORT", 8765))
+assert 0 < STRM_PROXY_PORT < 65536, "STRM_PROXY_PORT must be a valid port"
+STRM_PROXY_URL = os.getenv("STRM_PROXY_URL", f"http://127.0.0.1:{STRM_PROXY_PORT}").rstrip("/")
@@ -1,15 +1,19 @@
 import httpx
 from library.torbox import TORBOX_API_KEY
+from library.ratelimit import RateLimitedTransport, AsyncRateLimitedTransport
 import time
 import logging
 import hashlib
 import json
+import asyncio
+import threading
 
 TORBOX_API_URL = "https://api.torbox.app/v1/api"
 TORBOX_SEARCH_API_URL = "https://search-api.torbox.app"
 USER_AGENT = "TorBox-Media-Center/1.4 TorBox/1.0"
 CACHE_TTL = 300 # cache time-to-live in seconds
 _cache: dict[str, tuple[float, httpx.Response]] = {}
+_cache_lock = threading.Lock() # the cache is shared by the FUSE threads, the STRM proxy and the ingest loop
 
 def makeCacheKey(method: str, url: str, base_url: str, **kwargs) -> str:
     key_data = {
@@ -23,31 +27,33 @@ def makeCacheKey(method: str, url: str, base_url: str, **kwargs) -> str:
     key_str = json.dumps(key_data, sort_keys=True, default=str)
     return hashlib.sha256(key_str.encode()).hexdigest()
 
-transport = httpx.HTTPTransport(
-    retries=10
-)
+def getCachedResponse(cache_key: str):
+    """
+    Returns a cached response that hasn't expired yet, or None.
+    """
+    with _cache_lock:
+        cached = _cache.get(cache_key)
+        if cached is None:
+            return None
+        cached_time, cached_response = cached
+        if time.time() - cached_time >= CACHE_TTL:
+            del _cache[cache_key]
+            return None
+        return cached_response
 
-api_http_client = httpx.Client(
-    base_url=TORBOX_API_URL,
-    headers={
-        "Authorization": f"Bearer {TORBOX_API_KEY}",
-        "User-Agent": USER_AGENT,
-    },
-    timeout=httpx.Timeout(60),
-    follow_redirects=True,
-    transport=transport
-)
+def cacheResponse(cache_key: str, response: httpx.Response):
+    """
+    Caches a response, dropping expired responses, which would otherwise only be dropped when requested again.
+    """
+    now = time.time()
+    with _cache_lock:
+        for expired_key in [expired_key for expired_key, (cached_time, _) in _cache.items() if now - cached_time >= CACHE_TTL]:
+            del _cache[expired_key]
+        _cache[cache_key] = (now, response)
 
-search_api_http_client = httpx.Client(
-    base_url=TORBOX_SEARCH_API_URL,
-    headers={
-        "Authorization": f"Bearer {TORBOX_API_KEY}",
-        "User-Agent": USER_AGENT,
-    },
-    timeout=httpx.Timeout(60),
-    follow_redirects=True,
-    transport=transport,
-)
+transport = RateLimitedTransport(httpx.HTTPTransport(
+    retries=10
+))
 
 general_http_client = httpx.Client(
     headers={
@@ -59,6 +65,35 @@ general_http_client = httpx.Client(
     transport=transport,
 )
 
+def asyncApiClient() -> httpx.AsyncClient:
+    """
+    Returns a new async client for the TorBox API. Async clients are bound to the event loop they are used in, so every run creates its own.
+    """
+    return httpx.AsyncClient(
+        base_url=TORBOX_API_URL,
+        headers={
+            "Authorization": f"Bearer {TORBOX_API_KEY}",
+            "User-Agent": USER_AGENT,
+        },
+        timeout=httpx.Timeout(60),
+        follow_redirects=True,
+        transport=AsyncRateLimitedTransport(httpx.AsyncHTTPTransport(retries=10)),
+    )
+
+def asyncSearchApiClient() -> httpx.AsyncClient:
+    """
+    Returns a new async client for the TorBox search API.
+    """
+    return httpx.AsyncClient(
+        base_url=TORBOX_SEARCH_API_URL,
+        headers={
+            "Authorization": f"Bearer {TORBOX_API_KEY}",
+            "User-Agent": USER_AGENT,
+        },
+        timeout=httpx.Timeout(60),
+        follow_redirects=True,
+        transport=AsyncRateLimitedTransport(httpx.AsyncHTTPTransport(retries=10)),
+    )
 
 def requestWrapper(client: httpx.Client, method: str, url: str, use_cache: bool = True, **kwargs) -> httpx.Response:
     max_retries = 5
@@ -69,30 +104,27 @@ def requestWrapper(client: httpx.Client, method: str, url: str, use_cache: bool
     
     if cacheable:
         cache_key = makeCacheKey(method, url, str(client.base_url), **kwargs)
-        if cache_key in _cache:
-            cached_time, cached_response = _cache[cache_key]
-            if time.time() - cached_time < CACHE_TTL:
-                logging.debug(f"Cache hit for {url}")
-                return cached_response
-            else:
-                del _cache[cache_key]
+        cached_response = getCachedResponse(cache_key)
+        if cached_response is not None:
+            logging.debug(f"Cache hit for {url}")
+            return cached_response
     
     for attempt in range(max_retries):
         try:
             response = client.request(method, url, **kwargs)
-            response.raise_for_status()
+            if response.is_error: # redirects are returned, not raised
+                response.raise_for_status()
             
             if cacheable and cache_key:
-                _cache[cache_key] = (time.time(), response)
+                cacheResponse(cache_key, response)
                 logging.debug(f"Cached response for {url}")
             
             return response
         except httpx.HTTPStatusError as e:
             bad_response_codes = [429]
             if e.response.status_code in bad_response_codes:
-                wait_time = backoff_factor * (2 ** attempt)
-                logging.warning(f"Received {e.response.status_code} for {url}. Retrying in {wait_time:.2f} seconds...")
-                time.sleep(wait_time)
+                # the rate limiter holds the retry back for as long as the API asked
+                logging.warning(f"Received {e.response.status_code} for {url}. Retrying when the rate limit allows...")
             else:
                 logging.error(f"HTTP error for {url}: {e}")
                 raise
@@ -101,3 +133,42 @@ def requestWrapper(client: httpx.Client, method: str, url: str, use_cache: bool
             logging.warning(f"Request error on {url}: {e}. Retrying in {wait_time:.2f} seconds...")
             time.sleep(wait_time)
     raise httpx.RequestError(f"Failed to complete request to {url} after {max_retries} attempts.")
+
+async def asyncRequestWrapper(client: httpx.AsyncClient, method: str, url: str, use_cache: bool = True, **kwargs) -> httpx.Response:
+    max_retries = 5
+    backoff_factor = 1.5
+    
+    cacheable = use_cache and method.upper() == "GET" # only caching GET requests
+    cache_key = None
+    
+    if cacheable:
+        cache_key = makeCacheKey(method, url, str(client.base_url), **kwargs)
+        cached_response = getCachedResponse(cache_key)
+        if cached_response is not None:
+            logging.debug(f"Cache hit for {url}")
+            return cached_response
+    
+    for attempt in range(max_retries):
+        try:
+            response = await client.request(method, url, **kwargs)
+            if response.is_error: # redirects are returned, not raised
+                response.raise_for_status()
+            
+            if cacheable and cache_key:
+                cacheResponse(cache_key, response)
+                logging.debug(f"Cached response for {url}")
+            
+            return response
+        except httpx.HTTPStatusError as e:
+            bad_response_codes = [429]
+            if e.response.status_code in bad_response_codes:
+                # the rate limiter holds the retry back for as long as the API asked
+                logging.warning(f"Received {e.response.status_code} for {url}. Retrying when the rate limit allows...")
+            else:
+                logging.error(f"HTTP error for {url}: {e}")
+                raise
+        except httpx.RequestError as e:
+            wait_time = backoff_factor * (2 ** attempt)
+            logging.warning(f"Request error on {url}: {e}. Retrying in {wait_time:.2f} seconds...")
+            await asyncio.sleep(wait_time)
+    raise httpx.RequestError(f"Failed to complete request to {url} after {max_retries} attempts.")
@@ -0,0 +1,178 @@
+import httpx
+from email.utils import parsedate_to_datetime
+from library.app import API_RATE_LIMIT, API_MAX_CONCURRENCY
+import threading
+import asyncio
+import logging
+import time
+
+LATENCY_TOLERANCE = 2 # responses slower than twice the average count as congestion
+MIN_RATE = 0.5 # requests per second the rate never drops below
+MAX_BACKOFF = 60 # seconds to wait after a 429 without a Retry-After header
+
+class RateLimiter:
+    """
+    Token bucket rate limiter with an adaptive concurrency limit, shared by every client talking to a host.
+
+    Requests are paced by a token bucket refilled at the current rate. Both the rate and the number of
+    requests in flight grow additively while responses are fast and successful, both are halved on a 429,
+    and the concurrency limit shrinks when latency climbs, so requests run close to the allowed rate
+    without hitting it. A 429 also pauses every request to the host for as long as its Retry-After
+    header asks for.
+
+    Works from both threads and event loops, since waiting only ever happens in the callers.
+    """
+    def __init__(self, name: str, rate: float, max_concurrency: int):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.max_concurrency = max_concurrency
+        self.limit = max(1.0, max_concurrency / 4)
+        self.tokens = 1.0
+        self.refilled = time.monotonic()
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.backoff = 1.0
+        self.latency = None
+        self.lock = threading.Lock()
+
+    def _tryAcquire(self):
+        """
+        Takes a token and a concurrency slot, returning 0, or returns how many seconds to wait before trying again.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self.tokens = min(self.tokens + (now - self.refilled) * self.rate, max(self.rate, 1.0))
+            self.refilled = now
+            if self.in_flight >= int(self.limit):
+                return 0.05
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+            self.in_flight += 1
+            return 0
+
+    def acquire(self):
+        while (wait := self._tryAcquire()) > 0:
+            time.sleep(wait)
+
+    async def acquireAsync(self):
+        while (wait := self._tryAcquire()) > 0:
+            await asyncio.sleep(wait)
+
+    def release(self, latency: float, response: httpx.Response | None = None):
+        """
+        Frees the slot of a finished request and adapts the rate and concurrency limit to how it went.
+        """
+        with self.lock:
+            self.in_flight -= 1
+            if response is not None and response.status_code == httpx.codes.TOO_MANY_REQUESTS:
+                retry_after = parseRetryAfter(response.headers.get("Retry-After"))
+                if retry_after is None:
+                    retry_after = self.backoff
+                    self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+                self.rate = max(self.rate / 2, MIN_RATE)
+                self.limit = max(self.limit / 2, 1.0)
+                self.tokens = 0
+                logging.warning(f"Rate limited by {self.name}, pausing for {retry_after:.2f} seconds at {self.rate:.2f} requests/s and {int(self.limit)} concurrent requests")
+                return
+            if response is None:
+                return
+            self.backoff = 1.0
+            average = self.latency
+            self.latency = latency if average is None else average * 0.9 + latency * 0.1
+            if average is not None and latency > average * LATENCY_TOLERANCE:
+                self.limit = max(self.limit * 0.8, 1.0)
+                return
+            self.rate = min(self.rate + self.max_rate / 20, self.max_rate)
+            self.limit = min(self.limit + 1 / self.limit, self.max_concurrency)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "rate": self.rate,
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "latency": self.latency,
+            }
+
+def parseRetryAfter(value: str | None):
+    """
+    Returns the seconds to wait from a Retry-After header, given either in seconds or as a date.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+limiters = {
+    "api.torbox.app": RateLimiter("api.torbox.app", API_RATE_LIMIT, API_MAX_CONCURRENCY),
+    "search-api.torbox.app": RateLimiter("search-api.torbox.app", API_RATE_LIMIT, API_MAX_CONCURRENCY),
+}
+
+def getLimiter(host: str):
+    """
+    Returns the rate limiter of a host, or None for hosts that aren't rate limited, like the CDNs files are downloaded from.
+    """
+    return limiters.get(host)
+
+def limiterStats():
+    """
+    Returns the current rate, concurrency limit, requests in flight and latency of every rate limited host.
+    """
+    return {host: limiter.stats() for host, limiter in limiters.items()}
+
+class RateLimitedTransport(httpx.BaseTransport):
+    """
+    Transport that sends every request to a TorBox API through the rate limiter of its host.
+    """
+    def __init__(self, transport: httpx.BaseTransport):
+        self.transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        limiter = getLimiter(request.url.host)
+        if limiter is None:
+            return self.transport.handle_request(request)
+        limiter.acquire()
+        started = time.monotonic()
+        response = None
+        try:
+            response = self.transport.handle_request(request)
+            return response
+        finally:
+            limiter.release(time.monotonic() - started, response)
+
+    def close(self):
+        self.transport.close()
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    Async version of RateLimitedTransport, sharing the same limiters.
+    """
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        limiter = getLimiter(request.url.host)
+        if limiter is None:
+            return await self.transport.handle_async_request(request)
+        await limiter.acquireAsync()
+        started = time.monotonic()
+        response = None
+        try:
+            response = await self.transport.handle_async_request(request)
+            return response
+        finally:
+            limiter.release(time.monotonic() - started, response)
+
+    async def aclose(self):
+        await self.transport.aclose()
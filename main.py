@@ -1,9 +1,6 @@
-from apscheduler.schedulers.blocking import BlockingScheduler
-from apscheduler.schedulers.background import BackgroundScheduler
-from functions.appFunctions import bootUp, getMountMethod, getAllUserDownloadsFresh, getMountRefreshTime
-from functions.databaseFunctions import closeAllDatabases
 import logging
 from sys import platform
+from datetime import datetime
 
 logging.basicConfig(
     level=logging.INFO,
@@ -13,6 +10,14 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
 if __name__ == "__main__":
+    # imported here, so the parse worker processes, which import this module as well, don't load the application
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from apscheduler.events import EVENT_JOB_EXECUTED
+    from functions.appFunctions import bootUp, getMountMethod, getAllUserDownloadsFresh, getMountRefreshTime, getWarmStart, canWarmStart
+    from functions.databaseFunctions import closeAllDatabases
+    from functions.parseFunctions import stopParsePool
+
     bootUp()
     mount_method = getMountMethod()
 
@@ -27,19 +32,29 @@ if __name__ == "__main__":
         logging.error("Invalid mount method specified.")
         exit(1)
 
-    user_downloads = getAllUserDownloadsFresh()
+    if canWarmStart():
+        # mount what the last run stored right away and catch up with TorBox in the background
+        logging.info("Warm starting from the stored library, refreshing in the background...")
+        refresh_options = {"next_run_time": datetime.now()}
+    else:
+        getAllUserDownloadsFresh()
+        refresh_options = {}
 
     scheduler.add_job(
         getAllUserDownloadsFresh,
         "interval",
         hours=getMountRefreshTime(),
         id="get_all_user_downloads_fresh",
+        **refresh_options,
     )
 
+    proxy = None
     try:
         logging.info("Starting scheduler and mounting...")
         if mount_method == "strm":
             from functions.stremFilesystemFunctions import runStrm
+            from functions.strmProxyFunctions import startStrmProxy
+            proxy = startStrmProxy()
             runStrm()
             scheduler.add_job(
                 runStrm,
@@ -47,9 +62,23 @@ if __name__ == "__main__":
                 minutes=5,
                 id="run_strm",
             )
+
+            def onJobExecuted(event):
+                # bring the strm files up to date as soon as a refresh is done instead of at the next interval
+                if event.job_id == "get_all_user_downloads_fresh":
+                    scheduler.modify_job("run_strm", next_run_time=datetime.now())
+
+            scheduler.add_listener(onJobExecuted, EVENT_JOB_EXECUTED)
             scheduler.start()
         elif mount_method == "fuse":
-            from functions.fuseFilesystemFunctions import runFuse
+            from functions.fuseFilesystemFunctions import runFuse, reloadFuse
+
+            def onJobExecuted(event):
+                # show the refreshed files as soon as a refresh is done instead of at the next reload
+                if event.job_id == "get_all_user_downloads_fresh":
+                    reloadFuse()
+
+            scheduler.add_listener(onJobExecuted, EVENT_JOB_EXECUTED)
             scheduler.start()
             runFuse()
     except (KeyboardInterrupt, SystemExit):
@@ -58,6 +87,11 @@ if __name__ == "__main__":
             unmountFuse()
         elif mount_method == "strm":
             from functions.stremFilesystemFunctions import unmountStrm
-            unmountStrm()
+            from functions.strmProxyFunctions import stopStrmProxy
+            stopStrmProxy(proxy)
+            if not getWarmStart():
+                # the strm files are kept for the next start otherwise
+                unmountStrm()
+        stopParsePool()
         closeAllDatabases()
         exit(0)
\ No newline at end of file